@@ -0,0 +1,96 @@
+"""
+  Compares InsertQueryComposer with the previous, string concatenating
+  implementation. No database is needed.
+
+  Run from the repository root:
+  python benchmarks/insert_query_composer_benchmark.py [rows] [batch_size]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mysql_merge.insert_query_composer import InsertQueryComposer
+
+
+class LegacyInsertQueryComposer(object):
+    """
+      InsertQueryComposer as it was before statements were built from a list
+    """
+    _insert_part = None
+    _values_part_template = None
+    _values_part = None
+    values_count = None
+
+    def __init__(self, table_name, columns):
+        columns_clause = ""
+        values_clause = ""
+        for column in columns:
+            columns_clause += "`{column_name}`, ".format(
+                column_name=column['Field'])
+            val = "{{0[{column_name}]}}, "
+            values_clause += val.format(column_name=column['Field'])
+        columns_clause = columns_clause.rstrip(", ")
+        values_clause = values_clause.rstrip(", ")
+        self._insert_part = "INSERT INTO `" + table_name + "` (" + columns_clause + ") VALUES"
+        self._values_part_template = "(" + values_clause + "),"
+        self._values_part = ""
+        self.values_count = 0
+
+    def add_value(self, record):
+        self._values_part += self._values_part_template.format(record)
+        self.values_count += 1
+
+    def get_query(self):
+        if self.values_count == 0:
+            raise Exception("No values provided to InsertQueryComposer")
+        self._values_part = self._values_part.rstrip(",")
+        return "{insert}{values};".format(insert=self._insert_part, values=self._values_part)
+
+    def reset(self):
+        self.values_count = 0
+        self._values_part = ""
+
+
+COLUMNS = [{'Field': name} for name in ('id', 'user_id', 'email', 'name', 'created_at', 'score')]
+
+
+def make_row(i):
+    return ("%d" % i, "%d" % (i % 5000), "'user%d@example.com'" % i, "'User number %d'" % i,
+            "'2020-01-01 00:00:00'", "%d.5" % i)
+
+
+def run_legacy(rows, batch_size):
+    out = []
+    composer = LegacyInsertQueryComposer('user', COLUMNS)
+    names = [column['Field'] for column in COLUMNS]
+    started = time.time()
+    for i in xrange(rows):
+        composer.add_value(dict(zip(names, make_row(i))))
+        if composer.values_count == batch_size:
+            out.append(len(composer.get_query()))
+            composer.reset()
+    if composer.values_count:
+        out.append(len(composer.get_query()))
+    return time.time() - started, len(out)
+
+
+def run_current(rows, batch_size):
+    out = []
+    composer = InsertQueryComposer('user', COLUMNS, lambda query: out.append(len(query)), batch_size)
+    started = time.time()
+    for i in xrange(rows):
+        composer.add_value(make_row(i))
+    composer.flush()
+    return time.time() - started, len(out)
+
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+print "%d rows, %d rows per statement" % (rows, batch_size)
+print "%-8s %12s %12s %12s" % ("composer", "statements", "seconds", "rows/s")
+for name, run in (("legacy", run_legacy), ("current", run_current)):
+    elapsed, statements = run(rows, batch_size)
+    print "%-8s %12d %12.2f %12d" % (name, statements, elapsed, rows / elapsed)
@@ -0,0 +1,74 @@
+"""
+  Compares the bulk information_schema mapping with the legacy
+  per-table DESCRIBE / SHOW INDEXES mapping.
+
+  Run from the repository root:
+  python benchmarks/mapper_benchmark.py [repeats]
+
+  Maps the first db from config.merged_dbs with both engines, checks
+  that both produce the same map and prints round trips and wall time.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mysql_merge.utils import MiniLogger, create_connection
+from mysql_merge.mysql_mapper import Mapper
+from mysql_merge.options import config
+
+
+class CountingConnection(object):
+    """
+      Connection proxy counting every query sent to the server
+    """
+    queries = 0
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args):
+        return CountingCursor(self, self._conn.cursor(*args))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingCursor(object):
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def execute(self, query, *args):
+        self._counter.queries += 1
+        return self._cursor.execute(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def run(conn, db_name, bulk, repeats):
+    counting_conn = CountingConnection(conn)
+    started = time.time()
+    for i in range(repeats):
+        db_map = Mapper(counting_conn, db_name, MiniLogger(), verbose=False, bulk=bulk, use_cache=False).map_db()
+    elapsed = (time.time() - started) / repeats
+
+    return db_map, counting_conn.queries / repeats, elapsed
+
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+mapped_db = config.merged_dbs[0]
+conn = create_connection(mapped_db, config.common_data)
+
+legacy_map, legacy_queries, legacy_time = run(conn, mapped_db['db'], False, repeats)
+bulk_map, bulk_queries, bulk_time = run(conn, mapped_db['db'], True, repeats)
+
+conn.close()
+
+print "Mapped %d tables of `%s` (average of %d runs)" % (len(bulk_map), mapped_db['db'], repeats)
+print "%-8s %12s %12s" % ("engine", "round trips", "seconds")
+print "%-8s %12d %12.3f" % ("legacy", legacy_queries, legacy_time)
+print "%-8s %12d %12.3f" % ("bulk", bulk_queries, bulk_time)
+print "Maps are identical: %s" % (legacy_map == bulk_map)
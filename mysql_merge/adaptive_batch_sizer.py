@@ -0,0 +1,80 @@
+class AdaptiveBatchSizer(object):
+    """
+      Chooses the size of multi-row INSERT statements by measured throughput.
+      It starts from the largest statement the server accepts and, every
+      SAMPLE_STATEMENTS statements, grows or shrinks the size by FACTOR -
+      keeping the direction while throughput (bytes/s) improves and turning
+      back when it drops, so it stays near the peak. The size never exceeds
+      the limit given, usually max_allowed_packet.
+    """
+    MIN_BYTES = 65536
+    PACKET_MARGIN = 1024
+    SAMPLE_STATEMENTS = 4
+    FACTOR = 1.5
+
+    max_bytes = None
+
+    def __init__(self, max_bytes_limit, min_bytes=MIN_BYTES):
+        self._max_bytes_limit = max_bytes_limit
+        self._min_bytes = min(min_bytes, max_bytes_limit)
+        self.max_bytes = max_bytes_limit
+        self._direction = -1
+        self._last_throughput = None
+        # statements, rows, bytes, seconds
+        self._sample = [0, 0, 0, 0.0]
+        self._totals = [0, 0, 0, 0.0]
+        self._chosen = [self.max_bytes]
+
+    @classmethod
+    def for_connection(cls, conn):
+        """
+          Creates a sizer limited by max_allowed_packet of the connection's server
+        """
+        cur = conn.cursor()
+        cur.execute("SELECT @@max_allowed_packet AS max_allowed_packet")
+        row = cur.fetchone()
+        cur.close()
+        packet = row['max_allowed_packet'] if isinstance(row, dict) else row[0]
+        return cls(int(packet) - cls.PACKET_MARGIN)
+
+    def record(self, rows, size, elapsed):
+        """
+          Records a statement of rows rows and size bytes executed in elapsed seconds
+        """
+        for totals in (self._sample, self._totals):
+            totals[0] += 1
+            totals[1] += rows
+            totals[2] += size
+            totals[3] += elapsed
+
+        if self._sample[0] >= self.SAMPLE_STATEMENTS:
+            self._adjust(self._sample[2] / self._sample[3] if self._sample[3] else None)
+            self._sample = [0, 0, 0, 0.0]
+
+    def _adjust(self, throughput):
+        if throughput is None:
+            return
+        if self._last_throughput is not None and throughput < self._last_throughput:
+            self._direction = -self._direction
+        self._last_throughput = throughput
+
+        max_bytes = self._clamp(self.max_bytes * self.FACTOR ** self._direction)
+        if max_bytes == self.max_bytes:
+            # Hit a limit, the only way is back
+            self._direction = -self._direction
+            max_bytes = self._clamp(self.max_bytes * self.FACTOR ** self._direction)
+        self.max_bytes = max_bytes
+        self._chosen.append(max_bytes)
+
+    def _clamp(self, max_bytes):
+        return int(min(max(max_bytes, self._min_bytes), self._max_bytes_limit))
+
+    def get_summary(self):
+        """
+          @return string describing chosen sizes and measured throughput
+        """
+        statements, rows, size, elapsed = self._totals
+        return "%d statements of %.0f-%.0f KB (last %.0f KB, ~%d rows), %d rows/s, %.1f MB/s" % (
+            statements, min(self._chosen) / 1024.0, max(self._chosen) / 1024.0, self.max_bytes / 1024.0,
+            rows / statements if statements else 0,
+            rows / elapsed if elapsed else rows, size / 1048576.0 / elapsed if elapsed else 0)
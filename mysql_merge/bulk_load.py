@@ -0,0 +1,107 @@
+import threading
+from collections import defaultdict
+
+from mysql_merge.utils import register_cleanup, unregister_cleanup
+
+
+class BulkLoadProfile(object):
+    """
+      Drops secondary indexes of destination tables before they are loaded
+      and builds them again with one ALTER TABLE per table afterwards, which
+      is much cheaper than maintaining them row by row. Unique indexes and
+      indexes containing FK columns are kept.
+
+      DDL commits implicitly, so a separate connection has to be given.
+      Indexes can only be rebuilt once transactions writing to the tables
+      are finished. restore() is registered to run from handle_exception
+      (after the rollback) until it is called, and closes the connection.
+    """
+    _conn = None
+    _db_name = None
+    _logger = None
+
+    def __init__(self, conn, db_name, logger):
+        self._conn = conn
+        self._db_name = db_name
+        self._logger = logger
+        self._dropped = {}
+        self._lock = threading.Lock()
+
+    def get_droppable_indexes(self):
+        """
+          Returns non-unique BTREE indexes which don't contain FK columns
+
+          @return dict of table name -> list of tuples (index name, index definition)
+        """
+        cur = self._conn.cursor()
+        cur.execute("SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME " \
+                    "FROM information_schema.KEY_COLUMN_USAGE " \
+                    "WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_NAME IS NOT NULL", (self._db_name,))
+        fk_columns = defaultdict(set)
+        for row in cur.fetchall():
+            fk_columns[row['TABLE_NAME']].add(row['COLUMN_NAME'])
+            fk_columns[row['REFERENCED_TABLE_NAME']].add(row['REFERENCED_COLUMN_NAME'])
+
+        cur.execute("SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME, SUB_PART, COLLATION " \
+                    "FROM information_schema.STATISTICS " \
+                    "WHERE TABLE_SCHEMA = %s AND NON_UNIQUE = 1 AND INDEX_TYPE = 'BTREE' " \
+                    "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX", (self._db_name,))
+        index_columns = defaultdict(list)
+        for row in cur.fetchall():
+            index_columns[(row['TABLE_NAME'], row['INDEX_NAME'])].append(row)
+        cur.close()
+
+        indexes = defaultdict(list)
+        for (table_name, index_name), columns in sorted(index_columns.items()):
+            # Functional key parts have no column name
+            if any(column['COLUMN_NAME'] is None or column['COLUMN_NAME'] in fk_columns[table_name]
+                   for column in columns):
+                continue
+
+            parts = []
+            for column in columns:
+                part = "`%s`" % column['COLUMN_NAME']
+                if column['SUB_PART']:
+                    part += "(%d)" % column['SUB_PART']
+                if column['COLLATION'] == 'D':
+                    part += " DESC"
+                parts.append(part)
+            indexes[table_name].append((index_name, "INDEX `%s` (%s)" % (index_name, ", ".join(parts))))
+        return indexes
+
+    def drop_secondary_indexes(self, tables):
+        """
+          Drops droppable indexes of the given tables, remembering them for restore()
+        """
+        register_cleanup(self.restore)
+        indexes = self.get_droppable_indexes()
+        cur = self._conn.cursor()
+        for table_name in tables:
+            if not len(indexes.get(table_name, [])):
+                continue
+
+            self._logger.log("----> Dropping %d secondary indexes of `%s` for the time of copying" % (
+                len(indexes[table_name]), table_name))
+            cur.execute("ALTER TABLE `%s`.`%s` %s" % (self._db_name, table_name, ", ".join(
+                "DROP INDEX `%s`" % index_name for index_name, _ in indexes[table_name])))
+            with self._lock:
+                self._dropped[table_name] = indexes[table_name]
+        cur.close()
+
+    def restore(self):
+        """
+          Builds all the dropped indexes again
+        """
+        with self._lock:
+            dropped = self._dropped
+            self._dropped = {}
+
+        cur = self._conn.cursor()
+        for table_name, indexes in sorted(dropped.items()):
+            self._logger.log("----> Rebuilding %d secondary indexes of `%s`" % (len(indexes), table_name))
+            cur.execute("ALTER TABLE `%s`.`%s` %s" % (self._db_name, table_name, ", ".join(
+                "ADD %s" % definition for _, definition in indexes)))
+        cur.close()
+        unregister_cleanup(self.restore)
+        # The profile is done, its connection is not needed anymore
+        self._conn.close()
@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+
+
+class CheckpointJournal(object):
+    """
+      Records finished units of work (steps, copied tables) of a merge in a
+      local JSON file. The file is replaced atomically after every unit, so
+      it always describes work which was committed. A resumed merge skips
+      units found in the journal. Facts a resumed merge can't find in the
+      db anymore are kept in the journal as data.
+    """
+    _path = None
+
+    def __init__(self, path, resume=False):
+        self._path = path
+        self._lock = threading.Lock()
+        self._done = []
+        self._data = {}
+
+        if os.path.exists(path):
+            if not resume:
+                raise Exception("Found checkpoint journal %s of an unfinished merge. Run with --resume to "
+                                "continue it or remove the file to start from scratch." % path)
+            with open(path) as f:
+                journal = json.load(f)
+            self._done = journal['done']
+            self._data = journal.get('data', {})
+        else:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._write()
+
+    def _write(self):
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'done': self._done, 'data': self._data}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._path)
+
+    def is_done(self, unit):
+        with self._lock:
+            return unit in self._done
+
+    def get_done(self, prefix):
+        """
+          @return list of finished units starting with prefix
+        """
+        with self._lock:
+            return [unit for unit in self._done if unit.startswith(prefix)]
+
+    def mark_done(self, unit):
+        """
+          Records a unit of work. Call it only after the work is committed.
+        """
+        with self._lock:
+            if unit not in self._done:
+                self._done.append(unit)
+                self._write()
+
+    def get_data(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set_data(self, key, value):
+        """
+          Stores a JSON serializable value under key
+        """
+        with self._lock:
+            self._data[key] = value
+            self._write()
+
+    def remove(self):
+        """
+          Removes the journal once the whole merge is finished
+        """
+        with self._lock:
+            if os.path.exists(self._path):
+                os.remove(self._path)
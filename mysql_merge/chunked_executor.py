@@ -0,0 +1,82 @@
+import time
+
+
+class ChunkedExecutor(object):
+    """
+      Executes a statement over a table in bounded PK ranges.
+
+      Statements get a %(range)s placeholder, replaced with the condition of
+      the current chunk. The next boundary is looked up in the PK index only
+      after the previous chunk was executed, so a walk going away from the
+      rows moved by the statement never visits them again.
+    """
+    _cursor = None
+    _logger = None
+    _chunk_size = None
+
+    def __init__(self, cursor, logger, chunk_size):
+        self._cursor = cursor
+        self._logger = logger
+        self._chunk_size = chunk_size
+
+    def ranges(self, table, pk_col, descending=False, start=None):
+        """
+          Yields (condition, next_start) for every chunk, beginning at
+          start (inclusive) or at the edge of the table. next_start is
+          where the walk continues and None after the last chunk.
+        """
+        if not self._chunk_size:
+            yield "1=1", None
+            return
+
+        params = {'table': table, 'pk': pk_col}
+        if descending:
+            params.update({'bound': '<=', 'order': 'DESC'})
+        else:
+            params.update({'bound': '>=', 'order': 'ASC'})
+
+        bound = start
+        while True:
+            params['where'] = "" if bound is None else "WHERE `%s` %s %d" % (pk_col, params['bound'], bound)
+            params['offset'] = self._chunk_size - 1
+            row = self._cursor.execute(
+                "SELECT `%(pk)s` AS boundary FROM `%(table)s` %(where)s ORDER BY `%(pk)s` %(order)s LIMIT %(offset)d, 1" % params
+            ).fetchone()
+            boundary = row['boundary'] if row else None
+
+            low, high = (boundary, bound) if descending else (bound, boundary)
+            conditions = []
+            if low is not None:
+                conditions.append("`%s` >= %d" % (pk_col, low))
+            if high is not None:
+                conditions.append("`%s` <= %d" % (pk_col, high))
+            condition = " AND ".join(conditions) or "1=1"
+
+            if boundary is None:
+                yield condition, None
+                return
+
+            bound = boundary - 1 if descending else boundary + 1
+            yield condition, bound
+
+    def run(self, query, table, pk_col, descending=False, start=None, on_chunk=None):
+        """
+          Executes query chunk by chunk, logs per-chunk throughput and
+          calls on_chunk(next_start) after each chunk.
+
+          @return number of affected rows
+        """
+        total_rows = 0
+        for condition, next_start in self.ranges(table, pk_col, descending, start):
+            started = time.time()
+            rows = self._cursor.execute(query % {'range': condition}).rowcount
+            elapsed = time.time() - started
+            total_rows += max(rows, 0)
+
+            if self._chunk_size:
+                self._logger.log("----> `%s` %s: %d rows in %.2fs (%d rows/s)" % (
+                    table, condition, rows, elapsed, rows / elapsed if elapsed else rows))
+            if on_chunk:
+                on_chunk(next_start)
+
+        return total_rows
@@ -1,4 +1,4 @@
-from mysql_merge.config import ExecutionMode
+from mysql_merge.modes import ExecutionMode
 import MySQLdb
 
 
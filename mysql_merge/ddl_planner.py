@@ -0,0 +1,56 @@
+from collections import defaultdict
+
+
+class DdlPlanner(object):
+    """
+      Collects ALTER TABLE clauses and emits a single statement per table,
+      so the number of DDL operations depends on the number of tables and
+      not on the number of constraints.
+    """
+    _tables = None
+    _drops = None
+    _adds = None
+
+    def __init__(self):
+        self._tables = []
+        self._drops = defaultdict(list)
+        self._adds = defaultdict(list)
+
+    def _touch(self, table_name):
+        if table_name not in self._tables:
+            self._tables.append(table_name)
+
+    def drop_foreign_key(self, table_name, constraint_name):
+        self._touch(table_name)
+        self._drops[table_name].append("DROP FOREIGN KEY `%s`" % constraint_name)
+
+    def add_foreign_key(self, table_name, constraint_name, column, parent, parent_col):
+        self._touch(table_name)
+        self._adds[table_name].append(
+            "ADD CONSTRAINT `%s` FOREIGN KEY (`%s`) REFERENCES `%s` (`%s`) ON UPDATE CASCADE" % (
+                constraint_name, column, parent, parent_col))
+
+    def get_tables(self):
+        return list(self._tables)
+
+    def get_statement(self, table_name, algorithm='INPLACE'):
+        """
+          Returns one ALTER TABLE with every change planned for the table
+
+          @return string
+        """
+        clauses = self._drops[table_name] + self._adds[table_name]
+        if algorithm:
+            clauses.append("ALGORITHM=%s" % algorithm)
+        return "ALTER TABLE `%s` %s" % (table_name, ", ".join(clauses))
+
+    def get_fallback_statements(self, table_name):
+        """
+          Returns the same changes as two statements - all drops, then all
+          adds - for servers refusing to drop and re-add a constraint with
+          the same name in one ALTER TABLE.
+
+          @return list of strings
+        """
+        return ["ALTER TABLE `%s` %s" % (table_name, ", ".join(clauses))
+                for clauses in (self._drops[table_name], self._adds[table_name]) if len(clauses)]
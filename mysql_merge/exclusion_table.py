@@ -0,0 +1,187 @@
+import MySQLdb.cursors
+
+
+class ExclusionTable(object):
+    """
+      Indexed table of (table_name, pk) pairs left out of the merge.
+      Statements test rows against it with NOT EXISTS, so their size does
+      not depend on the number of excluded rows. A regular table is used
+      because MySQL can not refer to a temporary table twice in one query.
+
+      In dry runs nothing is written to the db: added pks are kept in memory
+      and pasted into conditions instead.
+    """
+    INSERT_BATCH_SIZE = 1000
+
+    _conn = None
+    _db_name = None
+    name = None
+    _dry_run = False
+
+    def __init__(self, conn, db_name, name, dry_run=False):
+        self._conn = conn
+        self._db_name = db_name
+        self.name = name
+        self._dry_run = dry_run
+        self._pks = {}
+
+    def create(self):
+        if self._dry_run:
+            return
+        # Drop the table left behind by a merge that failed before
+        self.drop()
+
+        cur = self._conn.cursor()
+        cur.execute("CREATE TABLE `%s`.`%s` (" \
+                    "`table_name` VARCHAR(64) NOT NULL, " \
+                    "`pk` BIGINT NOT NULL, " \
+                    "PRIMARY KEY (`table_name`, `pk`)" \
+                    ") ENGINE=InnoDB" % (self._db_name, self.name))
+        cur.close()
+
+    def drop(self):
+        if self._dry_run:
+            return
+        cur = self._conn.cursor()
+        cur.execute("SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%s' AND TABLE_NAME = '%s'" % (
+            self._db_name, self.name))
+        if cur.fetchone():
+            cur.execute("DROP TABLE `%s`.`%s`" % (self._db_name, self.name))
+        cur.close()
+
+    def add(self, table_name, pks):
+        pks = list(pks)
+        if self._dry_run:
+            self._pks.setdefault(table_name, set()).update(pks)
+            return
+        cur = self._conn.cursor()
+        for offset in range(0, len(pks), self.INSERT_BATCH_SIZE):
+            cur.executemany("INSERT INTO `%s`.`%s` (`table_name`, `pk`) VALUES (%%s, %%s) " \
+                            "ON DUPLICATE KEY UPDATE `pk` = VALUES(`pk`)" % (self._db_name, self.name),
+                            [(table_name, pk) for pk in pks[offset:offset + self.INSERT_BATCH_SIZE]])
+        cur.close()
+
+    def add_select(self, select_query):
+        """
+          Adds rows returned by select_query - (table_name, pk) columns
+        """
+        if self._dry_run:
+            cur = self._conn.cursor(MySQLdb.cursors.Cursor)
+            cur.execute(select_query)
+            for table_name, pk in cur.fetchall():
+                self._pks.setdefault(table_name, set()).add(pk)
+            cur.close()
+            return
+        cur = self._conn.cursor()
+        cur.execute("INSERT INTO `%s`.`%s` (`table_name`, `pk`) %s " \
+                    "ON DUPLICATE KEY UPDATE `pk` = VALUES(`pk`)" % (self._db_name, self.name, select_query))
+        cur.close()
+
+    def contains(self, table_name, column):
+        """
+          Returns condition true when the value of column is excluded for table_name
+
+          @return string
+        """
+        if self._dry_run:
+            pks = self._pks.get(table_name)
+            return "%s IN (%s)" % (column, ", ".join(str(int(pk)) for pk in sorted(pks))) if pks else "FALSE"
+        return "EXISTS (SELECT 1 FROM `%s`.`%s` x WHERE x.`table_name` = '%s' AND x.`pk` = %s)" % (
+            self._db_name, self.name, table_name, column)
+
+    def not_contains(self, table_name, column):
+        return "NOT %s" % self.contains(table_name, column)
+
+
+class RemapTable(ExclusionTable):
+    """
+      ExclusionTable which also keeps the PK each excluded row is mapped to.
+      The rows are not copied and FKs pointing to them are mapped to new_pk
+      by the copy SELECT, so the merged db is never changed.
+
+      The first pair added for a pk wins.
+    """
+
+    def create(self):
+        if self._dry_run:
+            return
+        self.drop()
+
+        cur = self._conn.cursor()
+        cur.execute("CREATE TABLE `%s`.`%s` (" \
+                    "`table_name` VARCHAR(64) NOT NULL, " \
+                    "`pk` BIGINT NOT NULL, " \
+                    "`new_pk` BIGINT NOT NULL, " \
+                    "PRIMARY KEY (`table_name`, `pk`)" \
+                    ") ENGINE=InnoDB" % (self._db_name, self.name))
+        cur.close()
+
+    def add(self, table_name, pairs):
+        """
+          Adds (pk, new_pk) pairs
+
+          @return number of pairs
+        """
+        pairs = list(pairs)
+        if self._dry_run:
+            mapped = self._pks.setdefault(table_name, {})
+            for pk, new_pk in pairs:
+                mapped.setdefault(pk, new_pk)
+            return len(pairs)
+        cur = self._conn.cursor()
+        for offset in range(0, len(pairs), self.INSERT_BATCH_SIZE):
+            cur.executemany("INSERT INTO `%s`.`%s` (`table_name`, `pk`, `new_pk`) VALUES (%%s, %%s, %%s) " \
+                            "ON DUPLICATE KEY UPDATE `new_pk` = `new_pk`" % (self._db_name, self.name),
+                            [(table_name, pk, new_pk) for pk, new_pk in pairs[offset:offset + self.INSERT_BATCH_SIZE]])
+        cur.close()
+        return len(pairs)
+
+    def add_select(self, select_query):
+        """
+          Adds rows returned by select_query - (table_name, pk, new_pk) columns
+
+          @return number of rows returned
+        """
+        cur = self._conn.cursor(MySQLdb.cursors.Cursor)
+        if self._dry_run:
+            cur.execute(select_query)
+            rows = cur.fetchall()
+            for table_name, pk, new_pk in rows:
+                self._pks.setdefault(table_name, {}).setdefault(pk, new_pk)
+            cur.close()
+            return len(rows)
+        # Qualified, as columns of the SELECT can be referred to in the UPDATE clause
+        cur.execute("INSERT INTO `%(db)s`.`%(name)s` (`table_name`, `pk`, `new_pk`) %(select)s " \
+                    "ON DUPLICATE KEY UPDATE `new_pk` = `%(db)s`.`%(name)s`.`new_pk`" % {
+                        'db': self._db_name, 'name': self.name, 'select': select_query})
+        count = cur.rowcount
+        cur.close()
+        return count
+
+    def get_tables(self):
+        """
+          @return set of names of tables having mapped rows
+        """
+        if self._dry_run:
+            return set(table_name for table_name, mapped in self._pks.items() if mapped)
+        cur = self._conn.cursor(MySQLdb.cursors.Cursor)
+        cur.execute("SELECT DISTINCT `table_name` FROM `%s`.`%s`" % (self._db_name, self.name))
+        tables = set(row[0] for row in cur.fetchall())
+        cur.close()
+        return tables
+
+    def mapped(self, table_name, column):
+        """
+          Returns expression of the PK the value of column is mapped to, NULL
+          when the row is not excluded
+
+          @return string
+        """
+        if self._dry_run:
+            mapped = self._pks.get(table_name)
+            if not mapped:
+                return "NULL"
+            return "CASE %s %s END" % (column, " ".join(
+                "WHEN %d THEN %d" % (int(pk), int(new_pk)) for pk, new_pk in sorted(mapped.items())))
+        return "(SELECT x.`new_pk` FROM `%s`.`%s` x WHERE x.`table_name` = '%s' AND x.`pk` = %s)" % (
+            self._db_name, self.name, table_name, column)
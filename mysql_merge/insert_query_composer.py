@@ -1,34 +1,80 @@
+import time
+
+
 class InsertQueryComposer(object):
+    """
+      Builds multi-row INSERT statements. Rows are kept in a list and joined
+      once per statement, which is passed to on_flush as soon as it holds
+      max_rows rows or the next row would make it longer than max_bytes.
+      When an AdaptiveBatchSizer is given, its current max_bytes is used
+      instead and it is told how long every on_flush took. With upsert rows
+      with an existing PK update it instead.
+    """
     _insert_part = None
-    _values_part_template = None
-    _values_part = None
+    _update_part = ""
+    _rows = None
+    _size = 0
+    _on_flush = None
+    _max_rows = None
+    _max_bytes = None
+    _sizer = None
     values_count = None
 
-    def __init__(self, table_name, columns):
-        columns_clause = ""
-        values_clause = ""
-        for column in columns:
-            columns_clause += "`{column_name}`, ".format(
-                column_name=column['Field'])
-            val = "{{0[{column_name}]}}, "
-            values_clause += val.format(column_name=column['Field'])
-        columns_clause = columns_clause.rstrip(", ")
-        values_clause = values_clause.rstrip(", ")
+    def __init__(self, table_name, columns, on_flush=None, max_rows=None, max_bytes=None, sizer=None, upsert=False):
+        columns_clause = ", ".join(["`%s`" % column['Field'] for column in columns])
         self._insert_part = "INSERT INTO `" + table_name + "` (" + columns_clause + ") VALUES"
-        self._values_part_template = "(" + values_clause + "),"
-        self._values_part = ""
-        self.values_count = 0
+        primary = [column['Field'] for column in columns if column.get('Key') == 'PRI']
+        if upsert and len(primary):
+            # Only the row with the same PK is updated, a row colliding on
+            # another unique key is left alone
+            same_row = " AND ".join(["`%(col)s`=VALUES(`%(col)s`)" % {'col': col} for col in primary])
+            self._update_part = " ON DUPLICATE KEY UPDATE " + (", ".join(
+                ["`%(col)s`=IF(%(same_row)s, VALUES(`%(col)s`), `%(col)s`)" % {
+                    'col': column['Field'], 'same_row': same_row}
+                 for column in columns if column['Field'] not in primary]) or "`%(col)s`=`%(col)s`" % {
+                'col': primary[0]})
+        self._on_flush = on_flush
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._sizer = sizer
+        self.reset()
 
-    def add_value(self, record):
-        self._values_part += self._values_part_template.format(record)
+    def add_value(self, values):
+        """
+          Adds a row - a sequence of escaped values in the order of columns
+        """
+        row = "(" + ", ".join(values) + ")"
+        max_bytes = self._sizer.max_bytes if self._sizer else self._max_bytes
+        if max_bytes and self.values_count and self._size + len(row) + 1 > max_bytes:
+            self.flush()
+
+        self._rows.append(row)
+        self._size += len(row) + 1
         self.values_count += 1
 
+        if self._max_rows and self.values_count >= self._max_rows:
+            self.flush()
+
     def get_query(self):
         if self.values_count == 0:
             raise Exception("No values provided to InsertQueryComposer")
-        self._values_part = self._values_part.rstrip(",")
-        return "{insert}{values};".format(insert=self._insert_part, values=self._values_part)
+        return self._insert_part + ",".join(self._rows) + self._update_part + ";"
+
+    def flush(self):
+        """
+          Passes the pending statement (if any) to on_flush
+        """
+        if self.values_count:
+            query = self.get_query()
+            if self._sizer:
+                started = time.time()
+                self._on_flush(query)
+                self._sizer.record(self.values_count, len(query), time.time() - started)
+            else:
+                self._on_flush(query)
+            self.reset()
 
     def reset(self):
         self.values_count = 0
-        self._values_part = ""
\ No newline at end of file
+        self._rows = []
+        self._size = len(self._insert_part) + len(self._update_part) + 1
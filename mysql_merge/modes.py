@@ -0,0 +1,14 @@
+from enum import Enum
+
+
+class ExecutionMode(Enum):
+    DEFAULT = 0
+    DRY_RUN = 1
+    IMPORT_FILE = 2
+    STREAM = 3
+    OUTFILE = 4
+
+
+class PkShiftMode(Enum):
+    UPDATE = 0
+    SELECT = 1
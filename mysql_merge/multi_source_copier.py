@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict, defaultdict
+
+from mysql_merge.table_order import dependency_waves, merge_fks
+from mysql_merge.utils import handle_exception
+
+
+class MultiSourceCopier(object):
+    """
+      Copies every table from all the merged dbs with a single
+      INSERT ... SELECT ... UNION ALL SELECT ... statement, so each table of
+      the destination db is written (and its indexes built) in one pass
+      instead of once per merged db. Every SELECT applies offsets and
+      exclusions of its own db.
+
+      All the dbs have to be on the destination server, prepared by their
+      Mergers and committed - the copy runs on a separate connection.
+      Rows of different dbs must not share values of unique indexes of the
+      destination db, they are looked for before anything is copied.
+    """
+    _mergers = None
+    _conn = None
+    _config = None
+    _logger = None
+
+    def __init__(self, mergers, conn, config, logger):
+        self._mergers = mergers
+        self._conn = conn
+        self._config = config
+        self._logger = logger
+
+    def copy(self):
+        if all(merger.is_step_done('copy') for merger in self._mergers):
+            self._logger.log("----> Data was copied in a previous run, skipping")
+            return
+
+        sources = []
+        for merger in self._mergers:
+            tables = set(merger.get_copy_tables())
+            sources.append((merger, tables, merger.get_shifted_pks()))
+
+        # FKs of a table may differ between the dbs, the copy order has to respect
+        # all of them and those of the destination db
+        tables = set(table_name for _, source_tables, _ in sources for table_name in source_tables)
+        db_maps = [merger.get_db_map() for merger in self._mergers] + [self._mergers[0].get_destination_db_map()]
+        waves, broken = dependency_waves(merge_fks(*db_maps), tables)
+        if self._config.copy_fk_checks and len(broken):
+            self._logger.log("----> Copying with FK checks disabled (self-referencing or in a cycle): %s" % (
+                ", ".join(sorted(broken))))
+
+        cur = self._conn.cursor()
+        cur.execute("set names utf8")
+        self.check_unique_conflicts(cur, sources, tables)
+        if self._config.bulk_load:
+            cur.execute("set unique_checks=0")
+            # Indexes are dropped once, by sizes of tables summed over all the dbs
+            table_sizes = defaultdict(int)
+            for merger in self._mergers:
+                for table_name, size in merger.get_table_sizes().items():
+                    table_sizes[table_name] += size
+            self._mergers[0].start_bulk_load(table_sizes)
+
+        for table_name in [table_name for wave in waves for table_name in wave]:
+            table_sources = [source for source in sources if table_name in source[1]]
+            if all(merger.is_copied(table_name) for merger, _, _ in table_sources):
+                self._logger.log("----> `%s` was copied in a previous run, skipping" % table_name)
+                continue
+
+            try:
+                started = time.time()
+                rows_count = 0
+                fk_checks = all(merger.get_copy_fk_checks(table_name, broken) for merger, _, _ in table_sources)
+                cur.execute("set foreign_key_checks=%d" % fk_checks)
+
+                # Dbs with a different set of columns get a statement of their own
+                selects = OrderedDict()
+                for merger, _, shifted_pks in table_sources:
+                    columns = merger.get_copy_columns(table_name)
+                    selects.setdefault(tuple(columns), []).append(
+                        merger.get_copy_select(table_name, columns, shifted_pks))
+
+                for columns, column_selects in selects.items():
+                    self._logger.qs = self._mergers[0].get_insert_select_query(
+                        table_name, list(columns), " UNION ALL ".join(column_selects))
+                    cur.execute(self._logger.qs)
+                    rows_count += cur.rowcount
+                self._conn.commit()
+            except Exception, e:
+                handle_exception("There was an error while copying table `%s` from all the databases" % table_name,
+                                 e, self._conn)
+
+            for merger, _, _ in table_sources:
+                merger.mark_copied(table_name)
+
+            elapsed = time.time() - started
+            self._logger.log("----> `%s`: %d rows from %d databases in %.2fs (%d rows/s)" % (
+                table_name, rows_count, len(table_sources), elapsed, rows_count / elapsed if elapsed else rows_count))
+        cur.close()
+
+        for merger in self._mergers:
+            merger.mark_copy_step_done("Copied data to the destination db in a single pass")
+
+    def check_unique_conflicts(self, cur, sources, tables):
+        """
+          Compares copied values of unique indexes of the destination db
+          between every two dbs. Conflicts with the destination db itself were
+          mapped by the Mergers, but conflicts between the dbs would make the
+          UNION ALL fail halfway through the copy.
+        """
+        destination_db_map = self._mergers[0].get_destination_db_map()
+        conflicts = []
+        for table_name in sorted(tables):
+            table_sources = [source for source in sources if table_name in source[1]]
+            if len(table_sources) < 2 or all(merger.is_copied(table_name) for merger, _, _ in table_sources):
+                continue
+
+            for index_name, index_columns in destination_db_map[table_name]['indexes'].items():
+                # Values as they are copied - with offsets and mapped FKs
+                selects = []
+                for merger, _, shifted_pks in table_sources:
+                    if all(column in merger.get_db_map()[table_name]['columns'] for column in index_columns):
+                        selects.append((merger, merger.get_copy_select(table_name, index_columns, shifted_pks)))
+
+                for i, (merger, select) in enumerate(selects):
+                    for other_merger, other_select in selects[i + 1:]:
+                        self._logger.qs = "SELECT COUNT(*) AS `count` FROM (%s) a JOIN (%s) b ON (%s)" % (
+                            select, other_select, " AND ".join(
+                                "a.`%(col)s` = b.`%(col)s` AND a.`%(col)s` IS NOT NULL" % {'col': column}
+                                for column in index_columns))
+                        cur.execute(self._logger.qs)
+                        count = cur.fetchone()['count']
+                        if count:
+                            conflicts.append("`%s`.`%s`: %d rows of %s conflict with %s" % (
+                                table_name, index_name, count, merger.get_source_db()['db'],
+                                other_merger.get_source_db()['db']))
+
+        if len(conflicts):
+            raise Exception("Merged databases share values of unique indexes, they can not be copied in a single "
+                            "pass:\n%s" % "\n".join(conflicts))
@@ -1,20 +1,25 @@
 from collections import defaultdict
+from hashlib import sha1
 import sys
 import copy
-from mysql_merge.config import tables_to_ignore
+from mysql_merge.options import config
+from mysql_merge.schema_map_cache import SchemaMapCache
 
 
 class Mapper(object):
+    # Tables created by the merge itself are never mapped
+    INTERNAL_TABLE_PREFIX = '_dbmerge_'
+
     db_map = {}
     table_map_template = {
         'columns': {},
         'primary': {},
         'unique': {},
-        'indexes': defaultdict(lambda: []),
-        'fk_host': defaultdict(lambda: []),
+        'indexes': defaultdict(list),
+        'fk_host': defaultdict(list),
         'fk_maybe': {},
         'fk_create': {},
-        'pk_changed_to_resolve_unique_conficts': []
+        'engine': None
     }
     _db_name = None
     _conn = None
@@ -22,11 +27,20 @@ class Mapper(object):
     _logger = None
     _verbose = True
     _tables_to_ignore = None
+    _bulk = True
+    _cache = None
+    _fingerprint = None
+    _role = None
 
-    def __init__(self, conn, db_name, logger, verbose=True):
+    def __init__(self, conn, db_name, logger, verbose=True, bulk=True, use_cache=True, role='source'):
+        """
+          role - 'source' or 'destination', maps of the same schema differ by role
+        """
         self.db_map = {}
+        self._role = role
 
         self._verbose = verbose
+        self._bulk = bulk
 
         self._db_name = db_name
         self._logger = logger
@@ -34,15 +48,95 @@ class Mapper(object):
         self._conn = conn
         self._cursor = self._conn.cursor()
 
-        self._tables_to_ignore = tables_to_ignore
+        self._tables_to_ignore = config.tables_to_ignore
+
+        if use_cache and config.schema_cache_dir:
+            self._cache = SchemaMapCache(config.schema_cache_dir)
 
     def map_db(self):
-        self._map_describe()
-        self._map_relations()
-        self._map_indexes()
+        if self._cache:
+            self._fingerprint = self.get_fingerprint()
+            db_map = self._cache.load(self._fingerprint)
+            if db_map is not None:
+                self._logger.log("---> Schema of '%s' loaded from cache" % self._db_name)
+                self.db_map = db_map
+                self._restore_default_mapping()
+                return self.db_map
+
+        if self._bulk:
+            self._map_columns()
+            self._map_relations()
+            self._map_unique_indexes()
+        else:
+            self._map_describe()
+            self._map_relations()
+            self._map_indexes()
 
         return self.db_map
 
+    def _restore_default_mapping(self):
+        # map_fks records FKs chosen at its prompts in default_mapping, a cached
+        # map skips the prompts, so the choices are taken from the map instead
+        for table_name, table_map in self.db_map.items():
+            for col_name, fk_data in table_map['fk_create'].items():
+                config.default_mapping.setdefault("%s.%s" % (table_name, col_name), "%s.%s" % (
+                    fk_data['parent'], fk_data['parent_col']))
+
+    def save_cache(self):
+        """
+          Stores current db_map in the schema cache. Call it after map_fks
+          so the FK mapping decisions are cached as well.
+        """
+        if self._cache and self._fingerprint:
+            self._cache.save(self._fingerprint, self.db_map)
+
+    def _is_ignored(self, table_name):
+        return table_name in self._tables_to_ignore or table_name.startswith(self.INTERNAL_TABLE_PREFIX)
+
+    def get_fingerprint(self):
+        """
+          Returns a checksum of the schema, computed by the server in a
+          single query over columns, indexes and constraints.
+
+          @return string
+        """
+        self._logger.qs = """
+    SELECT
+      (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+         TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, COLUMN_DEFAULT, EXTRA
+       ))), 0))
+       FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = '%(database)s' AND TABLE_NAME NOT LIKE '%(internal)s%%') `columns`,
+      (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+         TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE
+       ))), 0))
+       FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = '%(database)s' AND TABLE_NAME NOT LIKE '%(internal)s%%') `indexes`,
+      (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+         TABLE_NAME, COLUMN_NAME, CONSTRAINT_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+       ))), 0))
+       FROM information_schema.KEY_COLUMN_USAGE WHERE CONSTRAINT_SCHEMA = '%(database)s' AND TABLE_NAME NOT LIKE '%(internal)s%%') `constraints`,
+      (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+         TABLE_NAME, CONSTRAINT_NAME, UPDATE_RULE
+       ))), 0))
+       FROM information_schema.REFERENTIAL_CONSTRAINTS WHERE CONSTRAINT_SCHEMA = '%(database)s' AND TABLE_NAME NOT LIKE '%(internal)s%%') `rules`,
+      (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+         TABLE_NAME, ENGINE
+       ))), 0))
+       FROM information_schema.TABLES WHERE TABLE_SCHEMA = '%(database)s' AND TABLE_NAME NOT LIKE '%(internal)s%%') `engines`
+    """ % {"database": self._db_name, "internal": self.INTERNAL_TABLE_PREFIX.replace("_", "\\_")}
+        self._cursor.execute(self._logger.qs)
+        checksums = self._cursor.fetchone()
+
+        fingerprint = sha1()
+        fingerprint.update("%d" % SchemaMapCache.VERSION)
+        for key in ('columns', 'indexes', 'constraints', 'rules', 'engines'):
+            fingerprint.update("|%s" % checksums[key])
+        fingerprint.update("|%r" % sorted(self._tables_to_ignore))
+        # FK mapping config decides what map_fks adds to the cached map
+        fingerprint.update("|%s|%r|%r" % (self._role, sorted(config.default_mapping.items()),
+                                                    config.ignore_unlisted))
+
+        return fingerprint.hexdigest()
+
 
     def get_overlapping_tables(self, destination_map):
         """
@@ -100,18 +194,19 @@ class Mapper(object):
     def _map_describe(self):
         cur = self._cursor
 
-        cur.execute("SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '%(database)s'" % {
+        cur.execute("SELECT TABLE_NAME, ENGINE FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = '%(database)s'" % {
             "database": self._db_name})
 
         while True:
-            table = cur.fetchone()
-            if not table:
+            data = cur.fetchone()
+            if not data:
                 break
 
-            table = table.items()[0][1]
-            if table in self._tables_to_ignore:
+            table = data['TABLE_NAME']
+            if self._is_ignored(table):
                 continue
             table_map = copy.deepcopy(self.table_map_template)
+            table_map['engine'] = data['ENGINE']
 
             cur2 = self._conn.cursor()
             cur2.execute("DESCRIBE `%s`" % table)
@@ -121,29 +216,76 @@ class Mapper(object):
                 if not field:
                     break
 
-                is_int = "int" in field['Type'] or \
-                         "long" in field['Type']
-
-                append_conditions = {
-                'primary': field['Key'] == 'PRI' and is_int,
-                'unique': field['Key'] == 'UNI',
-                'fk_maybe': "_id" in field['Field'] and is_int,
-                'columns': True
-                }
-
-                if self._verbose and field['Key'] == 'PRI' and not is_int:
-                    self._logger.log(
-                        "Column `%s`.`%s` is a non-numeric primary key. It is not possible to " \
-                        "auto-handle it, therefore there could be some problems with it. Please " \
-                        "make sure its value is unique throughout all merged databases." % (table, field['Field'])
-                    )
-                for key, should_append in append_conditions.items():
-                    if should_append:
-                        field['is_int'] = is_int
-                        table_map[key][field['Field']] = field
+                self._map_field(table, table_map, field)
 
             self.db_map[table] = table_map
 
+    def _map_columns(self):
+        """
+          Maps the columns of all tables with a single query against
+          information_schema.COLUMNS. Rows are aliased to match the
+          output of DESCRIBE, so the resulting map is the same as the
+          one built by _map_describe.
+        """
+        cur = self._cursor
+
+        self._logger.qs = """
+    SELECT
+      c.TABLE_NAME,
+      t.ENGINE,
+      c.COLUMN_NAME `Field`,
+      c.COLUMN_TYPE `Type`,
+      c.IS_NULLABLE `Null`,
+      c.COLUMN_KEY `Key`,
+      c.COLUMN_DEFAULT `Default`,
+      c.EXTRA `Extra`
+    FROM
+      information_schema.COLUMNS c
+      JOIN information_schema.TABLES t ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+    WHERE
+      c.TABLE_SCHEMA = '%s'
+    ORDER BY
+      c.TABLE_NAME, c.ORDINAL_POSITION
+    """ % self._db_name
+        cur.execute(self._logger.qs)
+
+        while True:
+            field = cur.fetchone()
+            if not field:
+                break
+
+            table = field.pop('TABLE_NAME')
+            engine = field.pop('ENGINE')
+            if self._is_ignored(table):
+                continue
+            if table not in self.db_map:
+                self.db_map[table] = copy.deepcopy(self.table_map_template)
+                self.db_map[table]['engine'] = engine
+
+            self._map_field(table, self.db_map[table], field)
+
+    def _map_field(self, table, table_map, field):
+        is_int = "int" in field['Type'] or \
+                 "long" in field['Type']
+
+        append_conditions = {
+        'primary': field['Key'] == 'PRI' and is_int,
+        'unique': field['Key'] == 'UNI',
+        'fk_maybe': "_id" in field['Field'] and is_int,
+        'columns': True
+        }
+
+        if self._verbose and field['Key'] == 'PRI' and not is_int:
+            self._logger.log(
+                "Column `%s`.`%s` is a non-numeric primary key. It is not possible to " \
+                "auto-handle it, therefore there could be some problems with it. Please " \
+                "make sure its value is unique throughout all merged databases." % (table, field['Field'])
+            )
+        for key, should_append in append_conditions.items():
+            if should_append:
+                field['is_int'] = is_int
+                table_map[key][field['Field']] = field
+
 
     def _map_relations(self):
         cur = self._cursor
@@ -154,12 +296,17 @@ class Mapper(object):
       ke.referenced_column_name parent_col, 
       ke.table_name child, 
       ke.column_name child_col, 
-      ke.constraint_name 
+      ke.constraint_name,
+      rc.update_rule
     FROM 
       information_schema.KEY_COLUMN_USAGE ke 
+      LEFT JOIN information_schema.REFERENTIAL_CONSTRAINTS rc ON
+        rc.constraint_schema = ke.constraint_schema AND
+        rc.table_name = ke.table_name AND
+        rc.constraint_name = ke.constraint_name
     WHERE 
       ke.referenced_table_name IS NOT NULL AND
-      constraint_schema = '%s'
+      ke.constraint_schema = '%s'
     ORDER BY 
       ke.referenced_table_name
     """ % self._db_name
@@ -170,7 +317,7 @@ class Mapper(object):
             if not data:
                 break
             child = data['child']
-            if child in self._tables_to_ignore:
+            if self._is_ignored(child):
                 continue
             child_col = data['child_col']
 
@@ -194,7 +341,7 @@ class Mapper(object):
                 break
 
             table_name = data.values()[0]
-            if table_name in self._tables_to_ignore:
+            if self._is_ignored(table_name):
                 continue
 
             self._logger.qs = "SHOW INDEXES FROM %s" % table_name
@@ -211,5 +358,37 @@ class Mapper(object):
                 self.db_map[table_name]['indexes'][index['Key_name']].append(index['Column_name'])
 
         index_cur.close()
-    
-    
\ No newline at end of file
+
+    def _map_unique_indexes(self):
+        """
+          Maps unique indexes of all tables with a single query against
+          information_schema.STATISTICS - same result as _map_indexes.
+        """
+        cur = self._cursor
+
+        self._logger.qs = """
+    SELECT
+      s.TABLE_NAME,
+      s.INDEX_NAME,
+      s.COLUMN_NAME
+    FROM
+      information_schema.STATISTICS s
+    WHERE
+      s.TABLE_SCHEMA = '%s' AND
+      s.NON_UNIQUE = 0 AND
+      s.INDEX_NAME != 'PRIMARY'
+    ORDER BY
+      s.TABLE_NAME, s.INDEX_NAME, s.SEQ_IN_INDEX
+    """ % self._db_name
+        cur.execute(self._logger.qs)
+
+        while True:
+            index = cur.fetchone()
+            if not index:
+                break
+
+            table_name = index['TABLE_NAME']
+            if self._is_ignored(table_name) or table_name not in self.db_map:
+                continue
+
+            self.db_map[table_name]['indexes'][index['INDEX_NAME']].append(index['COLUMN_NAME'])
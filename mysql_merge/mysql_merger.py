@@ -1,18 +1,39 @@
-from mysql_merge.config import ExecutionMode
+from mysql_merge.modes import ExecutionMode, PkShiftMode
+from mysql_merge.bulk_load import BulkLoadProfile
+from mysql_merge.checkpoint_journal import CheckpointJournal
+from mysql_merge.chunked_executor import ChunkedExecutor
 from mysql_merge.cursor_wrapper import CursorWrapper
+from mysql_merge.ddl_planner import DdlPlanner
+from mysql_merge.exclusion_table import ExclusionTable, RemapTable
 from mysql_merge.insert_query_composer import InsertQueryComposer
+from mysql_merge.parallel_copier import ParallelCopier
 from mysql_merge.patch_file_helper import PatchFileHelper
-from mysql_merge.utils import MiniLogger, create_connection, handle_exception
+from mysql_merge.row_stream import stream_rows, escape_rows
+from mysql_merge.stream_copier import StreamCopier
+from mysql_merge.unique_conflict_detector import UniqueConflictDetector
+from mysql_merge.table_order import dependency_order, dependency_waves, merge_fks
+from mysql_merge.watermarks import WatermarkStore
+from mysql_merge.utils import MiniLogger, create_connection, handle_exception, register_cleanup, \
+    unregister_cleanup
 from mysql_merge.mysql_mapper import Mapper
 from mysql_merge.utils import map_fks, lists_diff
 import MySQLdb
+import MySQLdb.cursors
+import os
+import time
 import warnings
+from collections import defaultdict
 
 
 class Merger(object):
     CONST_STEPS = 9
+    PK_SHIFT_PROGRESS_TABLE = Mapper.INTERNAL_TABLE_PREFIX + 'pk_shift'
+    REMAPPED_PKS_TABLE = Mapper.INTERNAL_TABLE_PREFIX + 'remapped_pks'
+    IGNORED_IDS_TABLE = Mapper.INTERNAL_TABLE_PREFIX + 'ignored_ids'
+    ORPHANS_TABLE = Mapper.INTERNAL_TABLE_PREFIX + 'orphans'
     _conn = None
     _cursor = None
+    _destination_conn = None
 
     _source_mapper = None
     _db_map = None
@@ -28,8 +49,20 @@ class Merger(object):
     _execution_mode = ExecutionMode.DEFAULT
     _patch_file = None
     _self_referencing_tables = {}
+    _shift_pks_in_select = False
+    _has_pk_shift_progress = False
+    _ignored_ids = None
+    _remapped_pks = None
+    _remapped_tables = None
+    _bulk_load = None
+    _journal = None
+    _watermark_store = None
+    _watermark_conditions = {}
+    _new_watermarks = {}
+    _run_id = None
 
-    def __init__(self, execution_mode, destination_db_map, source_db, destination_db, config, counter, logger):
+    def __init__(self, execution_mode, destination_db_map, source_db, destination_db, config, counter, logger,
+                 resume=False):
 
         self._execution_mode = execution_mode
         self._destination_db_map = destination_db_map
@@ -41,11 +74,35 @@ class Merger(object):
         self._counter = counter
         self._logger = logger
 
+        self._self_referencing_tables = {}
+        self._watermark_conditions = {}
+        self._run_id = "%s-%d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid())
+        self._new_watermarks = {}
+
+        self._shift_pks_in_select = self._config.pk_shift_mode == PkShiftMode.SELECT
+
         self._step = 1
         self._total_steps = self.CONST_STEPS
-        if self._config.skip_ids_decrement:
+        if self._shift_pks_in_select:
+            self._total_steps -= 2
+        if self._config.skip_ids_decrement or self._shift_pks_in_select:
             self._total_steps -= 1
 
+        if self._config.incremental:
+            if execution_mode == ExecutionMode.OUTFILE:
+                raise Exception("Incremental merges are not supported in ExecutionMode.OUTFILE")
+            self._watermark_store = WatermarkStore(self._config.incremental_state_file)
+
+        if self._config.copy_workers > 1 and execution_mode in (ExecutionMode.DEFAULT, ExecutionMode.STREAM) and \
+                not self._shift_pks_in_select and not self._config.checkpoint_dir:
+            # Workers read committed data, a failed copy would leave the merged db with shifted PKs
+            raise Exception("copy_workers > 1 commits PKs incremented in the merged db before copying. Set "
+                            "pk_shift_mode = PkShiftMode.SELECT or checkpoint_dir to resume failed merges")
+
+        if self._config.checkpoint_dir and execution_mode != ExecutionMode.DRY_RUN:
+            self._journal = CheckpointJournal(os.path.join(
+                self._config.checkpoint_dir, "%s-%d.json" % (self._source_db['db'], counter)), resume)
+
         self._conn = create_connection(self._source_db)
         self._cursor = CursorWrapper(self._conn, self._logger, execution_mode == ExecutionMode.DRY_RUN)
 
@@ -61,6 +118,7 @@ class Merger(object):
 
         self._logger.log(" -> 2/2 Re-applying FKs mapping to current database schema - in case execution broke before")
         map_fks(db_map, False)
+        self._source_mapper.save_cache()
 
         self._db_map = db_map
 
@@ -78,12 +136,63 @@ class Merger(object):
     def __del__(self):
         if self._conn:
             self._conn.close()
+        if self._destination_conn:
+            self._destination_conn.close()
+
+    def get_destination_connection(self):
+        """
+          Returns a separate connection to the destination db, used when
+          data is streamed between servers
+        """
+        if not self._destination_conn:
+            self._destination_conn = create_connection(self._destination_db)
+            cur = self._destination_conn.cursor()
+            cur.execute("set names utf8")
+            cur.execute("set foreign_key_checks=0")
+            if self._config.bulk_load:
+                cur.execute("set unique_checks=0")
+            cur.close()
+            self._destination_conn.begin()
+        return self._destination_conn
 
     def _log_step(self, message):
+        if self._config.parallel_sources > 1:
+            message = "[%s] %s" % (self._source_db['db'], message)
         self._logger.log(" -> %d/%d %s" % (self._step, self._total_steps, message))
         self._step += 1
 
-    def merge(self):
+    def merge(self, copy_lock=None):
+        """
+          Runs all the steps for the source db. When copy_lock is given the
+          steps following prepare() wait for it, so merges running in
+          parallel look for unique conflicts only once the previous ones
+          have committed their rows to the destination db.
+        """
+        self.prepare()
+
+        if copy_lock:
+            with copy_lock:
+                self._merge_prepared()
+        else:
+            self._merge_prepared()
+
+    def _merge_prepared(self):
+        self.map_unique_conflicts()
+
+        def copy():
+            self.start_bulk_load()
+            self.copy_data_to_target()
+
+        self._run_step('copy', "Copying data to the destination db", copy)
+
+        self.finish()
+
+    def prepare(self, commit=False):
+        """
+          Runs the steps preceding the copy. With commit the changes are
+          committed, so the data can be copied by other connections.
+        """
+        self._create_exclusion_tables()
         self._conn.begin()
 
         self._logger.log(" ")
@@ -92,41 +201,171 @@ class Merger(object):
         self._fk_checks(False)
         self._step = 1
 
-        self._log_step("Executing preprocess_queries (specified in config)")
-        self.execute_preprocess_queries()
+        self._load_ignored_ids()
 
-        self._log_step("Converting tables to InnoDb")
-        self.convert_tables_to_innodb()
+        self._run_step('preprocess', "Executing preprocess_queries (specified in config)",
+                       self.execute_preprocess_queries)
 
-        self._log_step("Converting FKs to UPDATE CASCADE")
-        self.convert_fks_to_update_cascade()
+        self._run_step('innodb', "Converting tables to InnoDb", self.convert_tables_to_innodb)
 
-        self._log_step("Converting mapped FKs to real FKs")
-        self.convert_mapped_fks_to_real_fks()
+        if not self._shift_pks_in_select:
+            self._run_step('fks', "Converting FKs to UPDATE CASCADE and mapped FKs to real FKs",
+                           self.convert_fks_to_update_cascade)
+            self._load_self_referencing_tables()
 
-        self._log_step("Nulling orphaned FKs")
-        self.null_orphaned_fks()
+        self._run_step('orphans', "Nulling orphaned FKs", self.null_orphaned_fks)
 
         self._fk_checks(True)
 
-        self._log_step("Incrementing PKs")
-        self.change_pks()
+        if not self._shift_pks_in_select:
+            self._run_step('increment', "Incrementing PKs", self.change_pks)
 
         self._fk_checks(False)
+        if commit:
+            self._conn.commit()
 
-        self._log_step("Copying data to the destination db")
-        self.copy_data_to_target()
+    def map_unique_conflicts(self, commit=False):
+        """
+          Runs the step comparing unique values with the destination db - right
+          before the copy, so rows committed by previous merges are found.
+          With commit the pairs are committed for other connections.
+        """
+        self._run_step('unique', "Mapping PKs of rows conflicting with unique values of the destination db",
+                       self.map_pks_to_target_on_unique_conflict)
+        if commit:
+            self._conn.commit()
 
+    def finish(self):
+        """
+          Runs the steps following the copy and commits all the changes.
+        """
         self._fk_checks(True)
+        self._unique_checks(True)
 
-        if not self._config.skip_ids_decrement:
-            self._log_step("Decrementing PKs")
-            self.change_pks(-1)
+        if not self._config.skip_ids_decrement and not self._shift_pks_in_select:
+            self._run_step('decrement', "Decrementing PKs", lambda: self.change_pks(-1))
 
         self._log_step("Committing changes")
+        if self._destination_conn:
+            self._destination_conn.commit()
         self._conn.commit()
+        self._drop_pk_shift_progress()
+        self._drop_exclusion_tables()
+        self.finish_bulk_load()
+        if self._watermark_store and self._execution_mode != ExecutionMode.DRY_RUN:
+            self._watermark_store.save(self._source_db['db'], self._new_watermarks)
+        if self._journal:
+            self._journal.remove()
         self._logger.log("----------------------------------------")
 
+    def _run_step(self, name, message, step):
+        """
+          Runs a step of the merge. With a checkpoint journal the step is
+          committed and recorded when done, and skipped if it was recorded by
+          a previous run.
+        """
+        self._log_step(message)
+        if self._journal and self._journal.is_done("step:%s" % name):
+            self._logger.log("----> Already done in a previous run, skipping")
+            return
+
+        step()
+        if self._journal:
+            if self._destination_conn:
+                self._destination_conn.commit()
+            self._conn.commit()
+            self._journal.mark_done("step:%s" % name)
+
+    def is_step_done(self, name):
+        return self._journal is not None and self._journal.is_done("step:%s" % name)
+
+    def mark_copy_step_done(self, message):
+        """
+          Records the copy step of this db when it was done by another copier
+        """
+        self._log_step(message)
+        if self._journal:
+            self._journal.mark_done("step:copy")
+
+    def is_copied(self, table_name):
+        # Tables are journaled one by one only when they are copied to the destination db
+        return self._journal is not None and self._journal.is_done("copy:%s" % table_name)
+
+    def mark_copied(self, table_name):
+        if self._journal and self._execution_mode in (ExecutionMode.DEFAULT, ExecutionMode.STREAM):
+            if self._destination_conn:
+                self._destination_conn.commit()
+            self._conn.commit()
+            self._journal.mark_done("copy:%s" % table_name)
+
+    def start_bulk_load(self, table_sizes=None):
+        """
+          Applies the bulk load profile (config.bulk_load) to the destination db:
+          unique checks are disabled in sessions writing to it and secondary
+          indexes of tables bigger than bulk_load_drop_indexes_size are dropped
+          until finish_bulk_load (or handle_exception) builds them again.
+          table_sizes (table name -> bytes copied) defaults to tables of this db.
+        """
+        if not self._config.bulk_load or self._execution_mode not in (ExecutionMode.DEFAULT, ExecutionMode.STREAM):
+            return
+
+        if self._execution_mode == ExecutionMode.DEFAULT:
+            # INSERT ... SELECT runs in the merged db session
+            self._unique_checks(False)
+
+        if self._config.bulk_load_drop_indexes_size is not None:
+            if table_sizes is None:
+                table_sizes = self.get_table_sizes()
+            tables = [table_name for table_name, size in table_sizes.items()
+                      if size >= self._config.bulk_load_drop_indexes_size]
+            self._bulk_load = BulkLoadProfile(create_connection(self._destination_db), self._destination_db['db'],
+                                              self._logger)
+            self._bulk_load.drop_secondary_indexes(tables)
+            # Cleanups run in reverse order - the open destination transaction
+            # would block rebuilding indexes on error
+            register_cleanup(self._close_destination_connection)
+
+    def finish_bulk_load(self):
+        # Indexes can only be rebuilt once copied rows are committed
+        if self._bulk_load:
+            unregister_cleanup(self._close_destination_connection)
+            self._bulk_load.restore()
+            self._bulk_load = None
+
+    def _close_destination_connection(self):
+        # Closing the connection rolls back its transaction
+        if self._destination_conn:
+            self._destination_conn.close()
+            self._destination_conn = None
+
+    def _unique_checks(self, enable):
+        if self._config.bulk_load and self._execution_mode == ExecutionMode.DEFAULT:
+            self._cursor.execute("set unique_checks=%d" % (enable))
+
+    def _create_exclusion_tables(self):
+        # Created before the transaction of the merge begins, as DDL would
+        # commit it - the merge only inserts rows into them
+        self._ignored_ids = ExclusionTable(self._conn, self._source_db['db'], self.IGNORED_IDS_TABLE,
+                                           self._execution_mode == ExecutionMode.DRY_RUN)
+        self._ignored_ids.create()
+
+        # Pairs of a resumed merge are still needed by the copy
+        self._remapped_pks = self._get_remapped_pks_table()
+        if not self.is_step_done('unique'):
+            self._remapped_pks.create()
+
+    def _load_ignored_ids(self):
+        # ids_to_ignore are loaded once into an indexed table instead of being
+        # pasted into every statement
+        for table_name, ids in self._config.ids_to_ignore.items():
+            if table_name in self._db_map and len(ids):
+                self._ignored_ids.add(table_name, ids)
+
+    def _drop_exclusion_tables(self):
+        for exclusion_table in (self._ignored_ids, self._remapped_pks):
+            if exclusion_table:
+                exclusion_table.drop()
+
     def execute_preprocess_queries(self):
         for q in self._config.preprocess_queries:
             try:
@@ -138,16 +377,14 @@ class Merger(object):
 
     def convert_tables_to_innodb(self):
         # Convert all tables to InnoDB
-        for table_name in self._db_map.keys():
+        # Engines come from the schema map, views have none
+        for table_name, table_map in self._db_map.items():
             try:
-                rows = self._cursor.execute(
-                    "select engine from information_schema.TABLES where table_schema = '%s' and table_name = '%s'" % (
-                        self._source_db['db'], table_name))
-                data = rows.fetchone()
-                if data and data['engine'].lower() == 'innodb':
+                if not table_map['engine'] or table_map['engine'].lower() == 'innodb':
                     continue
 
                 self._cursor.execute("alter table `%s` engine InnoDB" % (table_name))
+                table_map['engine'] = 'InnoDB'
             # except _mysql_exceptions.OperationalError,e:
             except Exception, e:
                 handle_exception(
@@ -155,59 +392,110 @@ class Merger(object):
                     e, self._conn)
 
     def convert_fks_to_update_cascade(self):
-        # Convert FK to on update cascade
+        # Convert FKs to on update cascade and mapped FKs to real FKs.
+        # All changes of a table are applied by a single ALTER TABLE,
+        # FKs which already cascade are left alone
+        planner = DdlPlanner()
         for table_name, table_map in self._db_map.items():
             for col_name, fk_data in table_map['fk_host'].items():
-                try:
-                    self._cursor.execute("alter table `%s` drop foreign key `%s`" % (
-                        table_name, fk_data['constraint_name']))
-                    if table_name == fk_data['parent']:
-                        self._logger.log("---> self referencing table {table} FK: {fk}".format(
-                            table=table_name, fk=fk_data['constraint_name']))
-                        if table_name not in self._self_referencing_tables:
-                            self._self_referencing_tables[table_name] = set()
-                        self._self_referencing_tables[table_name].add(col_name)
-                        self._logger.log(self._self_referencing_tables)
-                    else:
-                        self._cursor.execute(
-                            "alter table `%s` add foreign key `%s` (`%s`) references `%s` (`%s`) on update cascade" % (
-                                table_name, fk_data['constraint_name'], col_name, fk_data['parent'],
-                                fk_data['parent_col']))
-                except Exception, e:
-                    handle_exception("There was an error while converting FK `%s` on `%s`.`%s` to ON UPDATE CASCADE" % (
-                        fk_data['constraint_name'], table_name, col_name), e, self._conn)
+                is_self_referencing = table_name == fk_data['parent']
+                if not is_self_referencing and fk_data.get('update_rule') == 'CASCADE':
+                    continue
+
+                planner.drop_foreign_key(table_name, fk_data['constraint_name'])
+                if is_self_referencing:
+                    self._logger.log("---> self referencing table {table} FK: {fk}".format(
+                        table=table_name, fk=fk_data['constraint_name']))
+                    if table_name not in self._self_referencing_tables:
+                        self._self_referencing_tables[table_name] = set()
+                    self._self_referencing_tables[table_name].add(col_name)
+                    self._logger.log(self._self_referencing_tables)
+                else:
+                    planner.add_foreign_key(table_name, fk_data['constraint_name'], col_name, fk_data['parent'],
+                                            fk_data['parent_col'])
 
-    def convert_mapped_fks_to_real_fks(self):
-        # Convert mapped FKs to real FKs
-        for table_name, table_map in self._db_map.items():
             for col_name, fk_data in table_map['fk_create'].items():
-                constraint_name = ""
+                fk_data['constraint_name'] = "%s_%s_dbmerge" % (
+                    table_name[0:25], col_name[0:25])  # max length of constraint name is 64
+                planner.add_foreign_key(table_name, fk_data['constraint_name'], col_name, fk_data['parent'],
+                                        fk_data['parent_col'])
+
+        # Dropped self-referencing FKs can't be mapped again, a resumed merge needs them to shift PKs back
+        self._save_self_referencing_tables()
+
+        for table_name in planner.get_tables():
+            try:
                 try:
-                    constraint_name = "%s_%s_dbmerge" % (
-                        table_name[0:25], col_name[0:25])  # max length of constraint name is 64
-                    self._cursor.execute(
-                        "alter table `%s` add foreign key `%s` (`%s`) references `%s` (`%s`) on update cascade" % (
-                            table_name, constraint_name, col_name, fk_data['parent'], fk_data['parent_col']))
-
-                    self._db_map[table_name]['fk_host'][col_name] = fk_data
-                    del self._db_map[table_name]['fk_create'][col_name]
-                except Exception, e:
-                    handle_exception("There was an error while creating new FK `%s` on `%s`.`%s`" % (
-                        constraint_name, table_name, col_name), e, self._conn)
+                    self._cursor.execute(planner.get_statement(table_name))
+                except MySQLdb.Error, e:
+                    # The whole ALTER failed and changed nothing, retry without the combined form
+                    self._logger.log("----> Combined ALTER of `%s` refused (%s), applying drops and adds separately" % (
+                        table_name, e))
+                    for statement in planner.get_fallback_statements(table_name):
+                        self._cursor.execute(statement)
+            except Exception, e:
+                handle_exception("There was an error while converting FKs on `%s` to ON UPDATE CASCADE" % (
+                    table_name), e, self._conn)
+
+        # Mapped FKs are real FKs from now on
+        for table_name, table_map in self._db_map.items():
+            table_map['fk_host'].update(table_map['fk_create'])
+            table_map['fk_create'].clear()
+            for col_name, fk_data in table_map['fk_host'].items():
+                if table_name != fk_data['parent']:
+                    fk_data['update_rule'] = 'CASCADE'
+
+    def _save_self_referencing_tables(self):
+        if not self._journal:
+            return
+        saved = self._journal.get_data('self_referencing_tables', {})
+        for table_name, columns in self._self_referencing_tables.items():
+            saved[table_name] = sorted(set(saved.get(table_name, [])) | columns)
+        self._journal.set_data('self_referencing_tables', saved)
+
+    def _load_self_referencing_tables(self):
+        # The FKs step of a previous run could have dropped them already
+        if not self._journal:
+            return
+        for table_name, columns in self._journal.get_data('self_referencing_tables', {}).items():
+            self._self_referencing_tables.setdefault(table_name, set()).update(columns)
 
     def null_orphaned_fks(self):
+        # Orphans of every FK are collected into a temporary table first and
+        # then nulled (or deleted) in bounded ranges of the collected keys, so
+        # no statement runs over the whole child table
         mapping = self._orphaned_rows_update_values.get('columns', {})
+        executor = ChunkedExecutor(self._cursor, self._logger, self._config.orphans_chunk_size)
+        cur = self._conn.cursor()
+        cur.execute("CREATE TEMPORARY TABLE `%s` (" \
+                    "`orphan_pk` BIGINT NOT NULL PRIMARY KEY" \
+                    ") ENGINE=InnoDB" % self.ORPHANS_TABLE)
 
-        for table_name, table_map in self._db_map.items():
-            for col_name, fk_data in table_map['fk_host'].items():
+        # Parents go first, so rows deleted there are handled in their children
+        # in the same pass instead of leaving new orphans behind
+        for table_name in dependency_order(self._db_map)[0]:
+            table_map = self._db_map[table_name]
+            # Mapped FKs are still in fk_create if they were not converted to real FKs
+            fks = dict(table_map['fk_create'])
+            fks.update(table_map['fk_host'])
+            # Orphans are collected by PK, which has to be a single int column
+            pks = [col_name for col_name, column in table_map['columns'].items() if column['Key'] == 'PRI']
+            pk_col = pks[0] if len(pks) == 1 and pks[0] in table_map['primary'] else None
+            for col_name, fk_data in fks.items():
                 params = {
                     'child': table_name,
                     'child_col': col_name,
                     'parent': fk_data['parent'],
                     'parent_col': fk_data['parent_col'],
-                    'value': mapping[col_name] if mapping.has_key(col_name) else "null"
+                    'value': mapping[col_name] if mapping.has_key(col_name) else "null",
+                    'pk_col': pk_col,
+                    'orphans': self.ORPHANS_TABLE
                 }
                 try:
+                    if pk_col:
+                        self._resolve_orphans_in_chunks(executor, cur, params)
+                        continue
+
                     try:
                         self._cursor.execute(
                             "UPDATE `%(child)s` c left join `%(parent)s` p on c.`%(child_col)s`=p.`%(parent_col)s` set c.`%(child_col)s`=%(value)s WHERE p.`%(parent_col)s` is null" % params)
@@ -220,169 +508,836 @@ class Merger(object):
                         "There was an error while nulling orphaned FK on `%s`.`%s`" % (table_name, col_name), e,
                         self._conn)
 
+        cur.execute("DROP TEMPORARY TABLE `%s`" % self.ORPHANS_TABLE)
+        cur.close()
+
+    def _resolve_orphans_in_chunks(self, executor, cur, params):
+        """
+          Collects PKs of rows of the child table pointing to nothing and
+          nulls (or maps) their FK in chunks. If that fails, rows which are
+          still orphaned are deleted instead.
+        """
+        started = time.time()
+        cur.execute("DELETE FROM `%(orphans)s`" % params)
+        self._logger.qs = "INSERT INTO `%(orphans)s` (`orphan_pk`) " \
+                          "SELECT c.`%(pk_col)s` FROM `%(child)s` c " \
+                          "LEFT JOIN `%(parent)s` p ON c.`%(child_col)s` = p.`%(parent_col)s` " \
+                          "WHERE c.`%(child_col)s` IS NOT NULL AND p.`%(parent_col)s` IS NULL" % params
+        orphans_count = self._cursor.execute(self._logger.qs).rowcount
+        # Nothing is collected in dry runs, the INSERT is only explained
+        if orphans_count <= 0 or self._execution_mode == ExecutionMode.DRY_RUN:
+            return
+
+        action = "nulled" if params['value'] == "null" else "updated"
+        try:
+            executor.run("UPDATE `%(child)s` c JOIN `%(orphans)s` o ON c.`%(pk_col)s` = o.`orphan_pk` " \
+                         "SET c.`%(child_col)s` = %(value)s WHERE %%(range)s" % params,
+                         self.ORPHANS_TABLE, 'orphan_pk')
+        except (MySQLdb.Warning, MySQLdb.IntegrityError), e:
+            # If nulling failed, let's delete problematic rows. Rows updated by
+            # earlier chunks are not orphans anymore, so they are kept
+            action = "deleted"
+            executor.run("DELETE c FROM `%(child)s` c JOIN `%(orphans)s` o ON c.`%(pk_col)s` = o.`orphan_pk` " \
+                         "LEFT JOIN `%(parent)s` p ON c.`%(child_col)s` = p.`%(parent_col)s` " \
+                         "WHERE c.`%(child_col)s` IS NOT NULL AND p.`%(parent_col)s` IS NULL AND %%(range)s" % params,
+                         self.ORPHANS_TABLE, 'orphan_pk')
+
+        self._logger.log("----> `%s`.`%s` -> `%s`: %d orphaned rows %s in %.2fs" % (
+            params['child'], params['child_col'], params['parent'], orphans_count, action, time.time() - started))
+
+    def get_shifted_pks(self):
+        """
+          Returns PK columns shifted by change_pks - numeric PKs which are not FKs at the same time.
+
+          @return dict { table_name: [pk_col, ...] }
+        """
+        shifted_pks = {}
+        for table_name, table_map in self._db_map.items():
+            columns = [col_name for col_name in table_map['primary'].keys()
+                       if col_name not in table_map['fk_host'] and col_name not in table_map['fk_create']]
+            if len(columns):
+                shifted_pks[table_name] = columns
+        return shifted_pks
+
+    def get_select_columns(self, table_name, columns, shifted_pks):
+        """
+          Returns SELECT expressions for copied columns. When PKs are shifted
+          in SELECT, the PK and every FK pointing to a shifted PK (directly or
+          through other FKs) get the same offset change_pks would apply.
+          Ignored ids keep their values. FKs pointing to rows taken over from
+          the destination db get the PKs of those rows.
+
+          @return list of strings
+        """
+        select_columns = []
+        for column in columns:
+            expression = None
+            parent = self.get_shifted_parent(table_name, column, shifted_pks) if self._shift_pks_in_select else None
+            if self._shift_pks_in_select and column in shifted_pks.get(table_name, []):
+                expression = "`%(col)s` + %(step)d" % {
+                    'col': column,
+                    'step': self.get_increment_value(table_name)
+                }
+            elif parent:
+                expression = "`%(col)s` + %(step)d" % {'col': column, 'step': self.get_increment_value(parent)}
+                if len(self._config.ids_to_ignore.get(parent, [])):
+                    expression = "IF(%(ignored)s, `%(col)s`, %(shifted)s)" % {
+                        'col': column,
+                        'ignored': self._ignored_ids.contains(parent, "`%s`.`%s`.`%s`" % (
+                            self._source_db['db'], table_name, column)),
+                        'shifted': expression
+                    }
+
+            remapped_parent = self.get_remapped_parent(table_name, column)
+            if remapped_parent:
+                expression = "COALESCE(%s, %s)" % (
+                    self._remapped_pks.mapped(remapped_parent, "`%s`.`%s`.`%s`" % (
+                        self._source_db['db'], table_name, column)),
+                    expression or "`%s`" % column)
+
+            select_columns.append("%s AS `%s`" % (expression, column) if expression else "`%s`" % column)
+        return select_columns
+
+    def get_pk_shift_parent(self, table_name, pk_col, shifted_pks):
+        """
+          @return name of the table whose increment the PK gets in the copy
+          SELECT or None when it is copied as it is
+        """
+        if not self._shift_pks_in_select:
+            return None
+        if pk_col in shifted_pks.get(table_name, []):
+            return table_name
+        return self.get_shifted_parent(table_name, pk_col, shifted_pks)
+
+    def get_copied_pk(self, shift_parent, column):
+        """
+          Returns expression of the value a PK of the merged db gets in the destination db
+
+          @param shift_parent result of get_pk_shift_parent
+          @param column qualified PK column
+        """
+        if not shift_parent:
+            return column
+        shifted = "%s + %d" % (column, self.get_increment_value(shift_parent))
+        if len(self._config.ids_to_ignore.get(shift_parent, [])):
+            return "IF(%s, %s, %s)" % (self._ignored_ids.contains(shift_parent, column), column, shifted)
+        return shifted
+
+    def get_remapped_parent(self, table_name, column):
+        """
+          @return name of the table the FK column points to, when some of its
+          rows are taken over from the destination db, or None
+        """
+        remapped_tables = self.get_remapped_tables()
+        if not remapped_tables:
+            return None
+        table_map = self._db_map[table_name]
+        fks = dict(table_map['fk_create'])
+        fks.update(table_map['fk_host'])
+        if column not in fks or fks[column]['parent'] not in remapped_tables:
+            return None
+        parent = fks[column]['parent']
+        if self._db_map[parent]['primary'].keys() != [fks[column]['parent_col']]:
+            return None
+        return parent
+
+    def get_shifted_parent(self, table_name, column, shifted_pks):
+        """
+          Follows FKs from the column to the shifted PK its values come from -
+          also through PKs which are FKs themselves (e.g. of 1:1 tables), as
+          the CASCADE of PkShiftMode.UPDATE does.
+
+          @return name of the table of the shifted PK or None
+        """
+        visited = set()
+        while (table_name, column) not in visited and table_name in self._db_map:
+            visited.add((table_name, column))
+            table_map = self._db_map[table_name]
+            fks = dict(table_map['fk_create'])
+            fks.update(table_map['fk_host'])
+            if column not in fks:
+                return None
+
+            table_name, column = fks[column]['parent'], fks[column]['parent_col']
+            if column in shifted_pks.get(table_name, []):
+                return table_name
+        return None
+
     def change_pks(self, order=1):
         # Update all numeric PKs to ID + (1 000 000) * order
+        # Increments walk the PK down and decrements walk it up, so rows
+        # moved by one chunk are never visited by the next one
+        descending = order > 0
+        executor = ChunkedExecutor(self._cursor, self._logger, self._config.pk_shift_chunk_size)
+        progress = self._get_pk_shift_progress()
+
         for table_name, table_map in self._db_map.items():
-            ignored_ids_clause = self._config.ids_to_ignore.get(table_name, [])
-            where_clause = "WHERE `Id` not in (%s)" % ", ".join(str(e) for e in ignored_ids_clause) \
-                if len(ignored_ids_clause) else ""
+            has_ignored_ids = len(self._config.ids_to_ignore.get(table_name, [])) > 0
             for col_name in table_map['primary'].keys():
                 # If current col is also a Foreign Key, we do not touch it
                 if table_map['fk_host'].has_key(col_name):
                     continue
 
                 increment_value = self.get_increment_value(table_name) * order
+                params = {
+                    'table': table_name,
+                    'pk': col_name,
+                    'step': increment_value,
+                    'order': 'DESC' if descending else 'ASC',
+                    'ignored': "AND %s" % self._ignored_ids.not_contains(table_name, "`%s`.`%s`" % (
+                        table_name, col_name)) if has_ignored_ids else ""
+                }
                 try:
+                    self._logger.log("UPDATE `%(table)s` SET `%(pk)s` = `%(pk)s` + %(step)d %(ignored)s" % params)
+                    self._shift_pk_chunks(
+                        executor, progress, table_name, col_name, 'pk', increment_value, descending,
+                        "UPDATE `%(table)s` SET `%(pk)s` = `%(pk)s` + %(step)d " \
+                        "WHERE %%(range)s %(ignored)s ORDER BY `%(pk)s` %(order)s" % params)
+
                     if table_name in self._self_referencing_tables:
-                        set_clause_add = ""
-                        set_clause = "`{c}` = `{c}` + {step}".format(
-                            c=col_name, step=increment_value)
-                        self._cursor.execute("UPDATE `{table}` SET {set_clause} {where}".format(
-                            table=table_name, set_clause=set_clause, where=where_clause))
                         self._fk_checks(False)
-                        for self_col_name in self._self_referencing_tables[table_name]:
-                            set_clause_add += "`{c}` = `{c}` + {step}, ".format(
-                                c=self_col_name, step=increment_value)
-                        self._logger.log("UPDATE `{table}` SET {set_clause_add}".format(
-                            table=table_name, set_clause_add=set_clause_add[:-2]))
-                        self._cursor.execute("UPDATE `{table}` SET {set_clause_add}".format(
-                            table=table_name, set_clause_add=set_clause_add[:-2]))
+                        params['set_clause'] = ", ".join(["`{c}` = `{c}` + {step}".format(c=self_col_name,
+                                                                                          step=increment_value)
+                                                          for self_col_name in
+                                                          self._self_referencing_tables[table_name]])
+                        self._logger.log("UPDATE `%(table)s` SET %(set_clause)s" % params)
+                        self._shift_pk_chunks(
+                            executor, progress, table_name, col_name, 'self', increment_value, False,
+                            "UPDATE `%(table)s` SET %(set_clause)s WHERE %%(range)s" % params)
                         self._fk_checks(True)
-                    else:
-                        self._logger.log(
-                            "UPDATE `%(table)s` SET `%(pk)s` = `%(pk)s` + %(step)d %(where)s" % {"table": table_name,
-                                                                                                "pk": col_name,
-                                                                                                "step": increment_value,
-                                                                                                "where": where_clause})
-                        self._cursor.execute(
-                            "UPDATE `%(table)s` SET `%(pk)s` = `%(pk)s` + %(step)d %(where)s" % {"table": table_name,
-                                                                                                "pk": col_name,
-                                                                                                "step": increment_value,
-                                                                                                "where": where_clause})
                 except Exception, e:
                     if table_name in self._self_referencing_tables:
                         self._fk_checks(True)
                     handle_exception("There was an error while updating PK `%s`.`%s` to %d + pk_value" % (
                         table_name, col_name, increment_value), e, self._conn)
 
+    def _shift_pk_chunks(self, executor, progress, table_name, col_name, phase, increment_value, descending, query):
+        key = (table_name, col_name, phase, increment_value)
+        if progress.get(key, {}).get('done'):
+            self._logger.log("----> `%s`.`%s` (%s) already shifted, skipping" % (table_name, col_name, phase))
+            return
+
+        on_chunk = None
+        if self._config.pk_shift_commit_chunks:
+            on_chunk = lambda next_pk: self._save_pk_shift_progress(key, next_pk)
+
+        executor.run(query, table_name, col_name, descending, progress.get(key, {}).get('next_pk'), on_chunk)
+        self._save_pk_shift_progress(key, None, True)
+
+    def _get_pk_shift_progress(self):
+        """
+          Creates (if needed) and reads the table with the high-water marks of
+          committed PK shift chunks. Empty unless pk_shift_commit_chunks is on.
+
+          @return dict { (table, column, phase, shift): {'next_pk': ..., 'done': ...} }
+        """
+        if not self._config.pk_shift_commit_chunks or self._execution_mode == ExecutionMode.DRY_RUN:
+            return {}
+
+        cur = self._conn.cursor()
+        cur.execute("SHOW TABLES LIKE '%s'" % self.PK_SHIFT_PROGRESS_TABLE.replace("_", "\\_"))
+        if not cur.fetchone():
+            cur.execute(
+                "CREATE TABLE `%s` (" \
+                "`table_name` VARCHAR(64) NOT NULL, " \
+                "`column_name` VARCHAR(64) NOT NULL, " \
+                "`phase` VARCHAR(8) NOT NULL, " \
+                "`shift` BIGINT NOT NULL, " \
+                "`next_pk` BIGINT NULL, " \
+                "`done` TINYINT NOT NULL DEFAULT 0, " \
+                "PRIMARY KEY (`table_name`, `column_name`, `phase`, `shift`)" \
+                ") ENGINE=InnoDB" % self.PK_SHIFT_PROGRESS_TABLE)
+
+        self._has_pk_shift_progress = True
+
+        cur.execute("SELECT * FROM `%s`" % self.PK_SHIFT_PROGRESS_TABLE)
+        progress = dict(((row['table_name'], row['column_name'], row['phase'], row['shift']), row)
+                        for row in cur.fetchall())
+        cur.close()
+        return progress
+
+    def _save_pk_shift_progress(self, key, next_pk, done=False):
+        # The high-water mark is committed together with the chunk it describes
+        if not self._config.pk_shift_commit_chunks or self._execution_mode == ExecutionMode.DRY_RUN:
+            return
+
+        cur = self._conn.cursor()
+        cur.execute("REPLACE INTO `%s` (`table_name`, `column_name`, `phase`, `shift`, `next_pk`, `done`) " \
+                    "VALUES (%%s, %%s, %%s, %%s, %%s, %%s)" % self.PK_SHIFT_PROGRESS_TABLE,
+                    key + (next_pk, int(done)))
+        cur.close()
+        self._conn.commit()
+
+    def _drop_pk_shift_progress(self):
+        if not self._has_pk_shift_progress:
+            return
+
+        self._cursor.execute("DROP TABLE `%s`" % self.PK_SHIFT_PROGRESS_TABLE)
+
     def map_pks_to_target_on_unique_conflict(self):
-        # Update all the PKs in the source db to the value from destination db
-        # if there's unique value collidinb with target database
-        if self._execution_mode == ExecutionMode.DEFAULT:
-            update_cur = CursorWrapper(self._conn, self._logger, self._execution_mode == ExecutionMode.DRY_RUN)
-            for table_name, table_map in self._db_map.items():
-                pks = table_map['primary'].keys()
-                if len(pks) != 1:
-                    continue
+        # Rows having the same unique value as a row of the destination db are
+        # not copied. FKs pointing to them are mapped to the PK of the
+        # destination row by the copy SELECT, the merged db is not changed.
+        # Dbs on another server (STREAM mode) are compared by hashed unique tuples
+        hashed = self._execution_mode == ExecutionMode.STREAM or self._config.unique_conflict_hash_index
+        if self._execution_mode not in (ExecutionMode.DEFAULT, ExecutionMode.STREAM):
+            return
 
-                pk_col = pks[0]
-                for index_name, columns in table_map['indexes'].items():
-                    new_pk = old_pk = ""
-                    try:
-                        # Get all rows that have the same unique value as our destination table
-                        rows = self._cursor.execute("SELECT t1.`%(pk_col)s` as old_pk, t2.`%(pk_col)s` as new_pk " \
-                                                    "FROM `%(table)s` t1 " \
-                                                    "LEFT JOIN `%(destination_db)s`.`%(table)s` t2 ON (%(join)s) " \
-                                                    "WHERE t2.`%(pk_col)s` is not null" % {
-                                                        'destination_db': self._destination_db['db'],
-                                                        "table": table_name,
-                                                        "pk_col": pk_col,
-                                                        "join": " AND ".join([
-                                                            "(t1.`%(column)s` = t2.`%(column)s` AND t2.`%(column)s` is not null)" % {
-                                                                'column': column} for column in columns])
-                                                    })
-
-                        # Update all those rows PKs - to trigger the CASCADE on all pointers
-                        while True:
-                            row = rows.fetchone()
-                            if not row:
-                                break
-
-                            new_pk, old_pk = row['new_pk'], row['old_pk']
-                            update_cur.execute(
-                                "UPDATE `%(table)s` set `%(pk_col)s`=%(new_pk)s where `%(pk_col)s`=%(old_pk)s" % {
-                                    'table': table_name,
-                                    'pk_col': pk_col,
-                                    'new_pk': row['new_pk'],
-                                    'old_pk': row['old_pk'],
-                                })
-                            self._db_map[table_name]['pk_changed_to_resolve_unique_conficts'].append(str(row['new_pk']))
-
-                    except Exception, e:
-                        handle_exception(
-                            "There was an error while normalizing unique index `%s`.`%s` from values '%s' to value '%s'" % (
-                                table_name, index_name, old_pk, new_pk), e, self._conn)
+        self._remapped_tables = None
+        shifted_pks = self.get_shifted_pks()
 
-    def copy_data_to_target(self):
+        for table_name, table_map in self._db_map.items():
+            pks = table_map['primary'].keys()
+            if len(pks) != 1 or not len(table_map['indexes']) or table_name not in self._destination_db_map:
+                continue
+
+            pk_col = pks[0]
+            detector = None
+            if hashed:
+                try:
+                    detector = self.get_unique_conflict_detector(table_name, pk_col)
+                except Exception, e:
+                    handle_exception("There was an error while reading unique values of `%s` from the "
+                                     "destination db" % table_name, e, self._conn)
+
+            for index_name, columns in table_map['indexes'].items():
+                params = {
+                    'destination_db': self._destination_db['db'],
+                    'table': table_name,
+                    'pk_col': pk_col,
+                    'shift_parent': self.get_pk_shift_parent(table_name, pk_col, shifted_pks),
+                    'columns': ", ".join("`%s`" % column for column in columns),
+                    'join': " AND ".join([
+                        "(t1.`%(column)s` = t2.`%(column)s` AND t2.`%(column)s` is not null)" % {
+                            'column': column} for column in columns]),
+                    'merged': ""
+                }
+                if self._config.incremental:
+                    # Rows copied by a previous merge conflict with themselves, they are upserted instead
+                    params['merged'] = "WHERE t2.`%s` <> %s" % (pk_col, self.get_copied_pk(
+                        params['shift_parent'], "t1.`%s`" % pk_col))
+                try:
+                    # Get all rows that have the same unique value as our destination table
+                    if detector:
+                        conflicts = self._add_hashed_unique_pairs(detector, index_name, params)
+                    else:
+                        self._logger.qs = "SELECT '%(table)s', t1.`%(pk_col)s`, t2.`%(pk_col)s` " \
+                                          "FROM `%(table)s` t1 " \
+                                          "JOIN `%(destination_db)s`.`%(table)s` t2 ON (%(join)s) " \
+                                          "%(merged)s" % params
+                        conflicts = self._remapped_pks.add_select(self._logger.qs)
+                    if conflicts:
+                        self._logger.log("----> `%s`.`%s`: %d rows conflicting with the destination db" % (
+                            table_name, index_name, conflicts))
+
+                except Exception, e:
+                    handle_exception(
+                        "There was an error while normalizing unique index `%s`.`%s`" % (
+                            table_name, index_name), e, self._conn)
+
+            if detector:
+                detector.close()
+
+    def _get_remapped_pks_table(self):
+        # Rows taken over from the destination db, with the PKs they are mapped to
+        return RemapTable(self._conn, self._source_db['db'], self.REMAPPED_PKS_TABLE,
+                          self._execution_mode == ExecutionMode.DRY_RUN)
+
+    def get_remapped_tables(self):
+        """
+          @return set of names of tables having rows mapped to the destination db
+        """
+        if not self._remapped_pks:
+            return set()
+        if self._remapped_tables is None:
+            self._remapped_tables = self._remapped_pks.get_tables()
+        return self._remapped_tables
+
+    def get_unique_conflict_detector(self, table_name, pk_col):
+        """
+          Streams unique tuples of the table from the destination db, with a
+          single scan for all its unique indexes
+
+          @return UniqueConflictDetector
+        """
+        detector = UniqueConflictDetector(self._db_map[table_name]['indexes'],
+                                          self._config.unique_conflict_memory_budget,
+                                          self._config.unique_conflict_normalize)
+        self._logger.qs = "SELECT `%s`, %s FROM `%s`" % (
+            pk_col, ", ".join("`%s`" % column for column in detector.get_columns()), table_name)
+        count = detector.load(stream_rows(self.get_destination_connection(), self._logger.qs,
+                                          self._config.batch_size))
+        self._logger.log("----> `%s`: %d rows of the destination db indexed%s" % (
+            table_name, count, ", spilled to disk" if detector.is_spilled() else ""))
+        return detector
+
+    def _add_hashed_unique_pairs(self, detector, index_name, params):
+        """
+          Probes rows of the merged db against the destination tuples of the
+          index and stores conflicting (pk, new_pk) pairs. Rows are read in
+          batches of batch_size PKs and pairs of each batch are stored before
+          the next one is read, so only the detector grows with the table.
+
+          @return number of pairs
+        """
+        parent = params['shift_parent']
+        ignored = set(self._config.ids_to_ignore.get(parent, [])) if parent else set()
+        increment_value = self.get_increment_value(parent) if parent else 0
+
+        batch_size = max(self._config.batch_size, 1)
+        count = 0
+        last_pk = None
+        cur = self._conn.cursor(MySQLdb.cursors.Cursor)
+        while True:
+            # Keyset pages on the connection of the merge - an unbuffered result
+            # would block the INSERTs of pairs and another connection would not
+            # see the PKs incremented in this transaction
+            self._logger.qs = "SELECT `%(pk_col)s`, %(columns)s FROM `%(table)s` %(after)s " \
+                              "ORDER BY `%(pk_col)s` LIMIT %(limit)d" % dict(params, **{
+                                  'after': "WHERE `%s` > %d" % (params['pk_col'], last_pk)
+                                  if last_pk is not None else "",
+                                  'limit': batch_size})
+            cur.execute(self._logger.qs)
+            rows = cur.fetchall()
+            if not len(rows):
+                break
+            last_pk = rows[-1][0]
+
+            pairs = detector.find(index_name, rows)
+            if self._config.incremental:
+                pairs = [(pk, new_pk) for pk, new_pk in pairs
+                         if new_pk != (pk if pk in ignored else pk + increment_value)]
+            count += self._remapped_pks.add(params['table'], pairs)
+            if len(rows) < batch_size:
+                break
+        cur.close()
+        return count
+
+    def get_db_map(self):
+        return self._db_map
+
+    def get_destination_db_map(self):
+        return self._destination_db_map
+
+    def get_source_db(self):
+        return self._source_db
+
+    def get_copy_tables(self):
+        """
+          Returns tables copied to the destination db, prepares watermarks of
+          incremental merges
+
+          @return list of table names
+        """
         diff_tables = self._source_mapper.get_non_overlapping_tables(self._destination_db_map)
         for k, v in diff_tables.items():
             if len(v):
                 self._logger.log("----> Skipping some missing tables in %s database: %s; " % (k, v))
 
-        patch = self.get_patch_file()
-        patch.write_line('SET FOREIGN_KEY_CHECKS = 0;')
+        tables = [table_name for table_name in self._db_map.keys()
+                  if not any([table_name in v for k, v in diff_tables.items()])]
+
+        if self._watermark_store:
+            self.prepare_incremental_copy(tables)
+        return tables
+
+    def copy_data_to_target(self):
+        tables = self.get_copy_tables()
+
+        # Referenced tables are copied first, so FK checks can stay enabled
+        waves, broken = self.get_copy_waves(tables)
+        if self._config.copy_fk_checks and len(broken):
+            self._logger.log("----> Copying with FK checks disabled (self-referencing or in a cycle): %s" % (
+                ", ".join(sorted(broken))))
+
+        if self._config.copy_workers > 1 and self._execution_mode in (ExecutionMode.DEFAULT, ExecutionMode.STREAM):
+            self.copy_data_in_parallel(waves, broken)
+            return
+
+        patch = None
+        if self._execution_mode in (ExecutionMode.IMPORT_FILE, ExecutionMode.OUTFILE):
+            patch = self.get_patch_file()
+
+        shifted_pks = self.get_shifted_pks()
 
         # Copy all the data to destination table
-        for table_name, table_map in self._db_map.items():
-            if any([table_name in v for k, v in diff_tables.items()]):
+        for table_name in [table_name for wave in waves for table_name in wave]:
+            table_map = self._db_map[table_name]
+            if self.is_copied(table_name):
+                self._logger.log("----> `%s` was copied in a previous run, skipping" % table_name)
                 continue
             try:
-                ignored_records = self._config.ids_to_ignore.get(table_name, [])
-                ignored_records += table_map['pk_changed_to_resolve_unique_conficts']
-                where = "" if not len(ignored_records) else "WHERE %(pk_col)s NOT IN (%(ids)s)" % {
-                        'pk_col': table_map['primary'].keys()[0],
-                        'ids': ",".join(map(str, ignored_records))
-                    }
+                fk_checks = self.get_copy_fk_checks(table_name, broken)
+                if self._execution_mode == ExecutionMode.STREAM:
+                    cur = self.get_destination_connection().cursor()
+                    cur.execute("set foreign_key_checks=%d" % fk_checks)
+                    cur.close()
+                elif self._execution_mode in (ExecutionMode.DEFAULT, ExecutionMode.DRY_RUN):
+                    self._fk_checks(fk_checks)
 
-                diff_columns = self._source_mapper.get_non_overlapping_columns(self._destination_db_map, table_name)
-                for k, v in diff_columns.items():
-                    if len(v):
-                        self._logger.log(
-                            "----> Skipping some missing columns in %s database in table %s: %s; " % (k, table_name, v))
-
-                columns = self._source_mapper.get_overlapping_columns(self._destination_db_map, table_name)
-                select_from_src_query = "SELECT %(columns)s FROM `%(source_db)s`.`%(table)s` %(where)s;" % {
-                        'source_db': self._source_db['db'],
-                        'table': table_name,
-                        'where': where,
-                        'columns': "`%s`" % ("`,`".join(columns))
-                    }
-                if not len(columns):
-                    raise Exception("Table %s have no intersecting column in merged database and destination database")
+                columns = self.get_copy_columns(table_name)
+                select_from_src_query = self.get_copy_select(table_name, columns, shifted_pks)
 
                 if self._execution_mode == ExecutionMode.IMPORT_FILE:
                     columns_descriptor = [
                         table_map['columns'][x] for x in columns]
-                    query_composer = InsertQueryComposer(table_name, columns_descriptor)
-                    rows = self._cursor.execute(select_from_src_query)
-                    while True:
-                        row = rows.fetchone()
-                        if not row:
-                            if query_composer.values_count:
-                                patch.write_line(query_composer.get_query())
-                                query_composer.reset()
-                            break
-                        for key, value in row.items():
-                            row[key] = self._conn.escape(value, self._conn.encoders)
-                        query_composer.add_value(row)
-                        if query_composer.values_count == self._config.batch_size:
-                            patch.write_line(query_composer.get_query())
-                            query_composer.reset()
+                    query_composer = InsertQueryComposer(table_name, columns_descriptor, patch.write_line,
+                                                         self._config.batch_size, self._config.batch_max_bytes,
+                                                         upsert=self._config.incremental)
+                    patch.begin_table(table_name, self.get_parent_tables(table_name))
+                    self._logger.qs = select_from_src_query
+                    rows_count = 0
+                    rows = stream_rows(self._conn, select_from_src_query, self._config.batch_size)
+                    for values in escape_rows(self._conn, rows):
+                        query_composer.add_value(values)
+                        rows_count += 1
+                    query_composer.flush()
+                    patch.end_table(rows_count)
+                elif self._execution_mode == ExecutionMode.OUTFILE:
+                    patch.begin_table(table_name, self.get_parent_tables(table_name))
+                    rows_count = self.export_to_outfile(table_name, columns, select_from_src_query, patch)
+                    patch.end_table(rows_count)
+                elif self._execution_mode == ExecutionMode.STREAM:
+                    columns_descriptor = [
+                        table_map['columns'][x] for x in columns]
+                    self.get_stream_copier().copy(table_name, columns_descriptor, select_from_src_query)
                 else:
-                    self._cursor.execute(
-                        "INSERT INTO `%(destination_db)s`.`%(table)s` (%(columns)s) %(select)s" % {
-                            'destination_db': self._destination_db['db'],
-                            'source_db': self._source_db['db'],
-                            'table': table_name,
-                            'select': select_from_src_query,
-                            'columns': "`%s`" % ("`,`".join(columns))
-                        })
+                    self._cursor.execute(self.get_insert_select_query(table_name, columns, select_from_src_query))
+                self.mark_copied(table_name)
             except Exception, e:
                 hint = "--> HINT: Looks like you runned this script twice on the same database\n" if "Duplicate" in "%s" % e else ""
                 handle_exception(
                     ("There was an error while moving data between databases. Table: `%s`.\n" + hint) % (table_name), e,
                     self._conn)
-        patch.write_line('SET FOREIGN_KEY_CHECKS = 1;')
+        if patch:
+            patch.close()
+
+    def get_copy_where(self, table_name, condition=None):
+        """
+          Returns the where clause skipping ignored and remapped rows of the table
+        """
+        table_map = self._db_map[table_name]
+        pk_col = table_map['primary'].keys()[0] if len(table_map['primary']) else None
+        source_pk = "`%s`.`%s`.`%s`" % (self._source_db['db'], table_name, pk_col)
+        conditions = [condition] if condition else []
+        if table_name in self._watermark_conditions:
+            conditions.append(self._watermark_conditions[table_name])
+        if len(self._config.ids_to_ignore.get(table_name, [])):
+            conditions.append(self._ignored_ids.not_contains(table_name, source_pk))
+        if self._remapped_pks and pk_col:
+            conditions.append(self._remapped_pks.not_contains(table_name, source_pk))
+        return "" if not len(conditions) else "WHERE %s" % " AND ".join(conditions)
+
+    def get_copy_columns(self, table_name):
+        """
+          Returns columns copied to the destination table
+
+          @return list of column names
+        """
+        diff_columns = self._source_mapper.get_non_overlapping_columns(self._destination_db_map, table_name)
+        for k, v in diff_columns.items():
+            if len(v):
+                self._logger.log(
+                    "----> Skipping some missing columns in %s database in table %s: %s; " % (k, table_name, v))
+
+        columns = self._source_mapper.get_overlapping_columns(self._destination_db_map, table_name)
+        if not len(columns):
+            raise Exception("Table %s have no intersecting column in merged database and destination database" % table_name)
+        return columns
+
+    def get_copy_select(self, table_name, columns, shifted_pks, condition=None):
+        """
+          Returns the SELECT reading columns of rows copied to the destination table
+        """
+        return "SELECT %(columns)s FROM `%(source_db)s`.`%(table)s` %(where)s" % {
+                'source_db': self._source_db['db'],
+                'table': table_name,
+                'where': self.get_copy_where(table_name, condition),
+                'columns': ", ".join(self.get_select_columns(table_name, columns, shifted_pks))
+            }
+
+    def get_insert_select_query(self, table_name, columns, select_query):
+        params = {
+            'destination_db': self._destination_db['db'],
+            'table': table_name,
+            'select': select_query,
+            'columns': "`%s`" % ("`,`".join(columns))
+        }
+        primary = [column for column in columns if self._db_map[table_name]['columns'][column]['Key'] == 'PRI']
+        if not self._config.incremental or not len(primary):
+            return "INSERT INTO `%(destination_db)s`.`%(table)s` (%(columns)s) %(select)s" % params
+
+        # Columns of the derived table can be referred to in every MySQL version,
+        # unlike VALUES() or row aliases. Only the row with the same PK is
+        # updated, a row colliding on another unique key is left alone
+        same_row = " AND ".join(["`%(col)s` = src.`%(col)s`" % {'col': column} for column in primary])
+        params['update'] = ", ".join(["`%(col)s` = IF(%(same_row)s, src.`%(col)s`, `%(col)s`)" % {
+            'col': column, 'same_row': same_row} for column in columns if column not in primary]) or \
+            "`%(col)s` = `%(col)s`" % {'col': primary[0]}
+        return "INSERT INTO `%(destination_db)s`.`%(table)s` (%(columns)s) " \
+               "SELECT * FROM (%(select)s) src ON DUPLICATE KEY UPDATE %(update)s" % params
+
+    def get_watermark_column(self, table_name):
+        """
+          Returns the column used as the watermark of the table and its offset
+          - the value added to it by change_pks while data is copied
+
+          @return tuple (column name, offset), (None, 0) if the table has no watermark
+        """
+        if table_name in self._config.incremental_columns:
+            return self._config.incremental_columns[table_name], 0
+
+        shifted_pks = self.get_shifted_pks().get(table_name, [])
+        if len(shifted_pks) != 1 or len(self._db_map[table_name]['primary']) != 1:
+            return None, 0
+        return shifted_pks[0], 0 if self._shift_pks_in_select else self.get_increment_value(table_name)
+
+    def prepare_incremental_copy(self, tables):
+        """
+          Limits the copy of every table to rows above its watermark and up to
+          the current max value of the column, which becomes the new watermark.
+          Tables without a watermark column are copied whole, rows existing in
+          the destination db are updated.
+        """
+        watermarks = self._watermark_store.load(self._source_db['db'])
+        cur = self._conn.cursor()
+        for table_name in tables:
+            column, offset = self.get_watermark_column(table_name)
+            if not column:
+                self._logger.log("----> `%s`: no watermark column, copying all rows" % table_name)
+                continue
+
+            source_column = "`%s`.`%s`.`%s`" % (self._source_db['db'], table_name, column)
+            cur.execute("SELECT MAX(%s) AS max_value FROM `%s`.`%s`" % (source_column, self._source_db['db'], table_name))
+            max_value = cur.fetchone()['max_value']
+            previous = watermarks.get(table_name, {})
+            old_value = previous.get('value') if previous.get('column') == column else None
+
+            if max_value is None:
+                # Nothing to copy, the table may have been emptied
+                self._watermark_conditions[table_name] = "1 = 0"
+                if old_value is not None:
+                    self._new_watermarks[table_name] = previous
+                continue
+
+            if offset:
+                max_value -= offset
+            conditions = ["%s <= %s" % (source_column, self._conn.literal(self._shift_value(max_value, offset)))]
+            if old_value is not None:
+                conditions.append("%s > %s" % (source_column, self._conn.literal(self._shift_value(old_value, offset))))
+            self._watermark_conditions[table_name] = " AND ".join(conditions)
+            self._new_watermarks[table_name] = {
+                'column': column,
+                'value': max_value if isinstance(max_value, (int, long)) else str(max_value)
+            }
+            self._logger.log("----> `%s`: copying rows with `%s` in (%s, %s]" % (
+                table_name, column, old_value if old_value is not None else "-inf", max_value))
+        cur.close()
+
+    def _shift_value(self, value, offset):
+        return value + offset if offset else value
+
+    def get_copy_waves(self, tables):
+        """
+          Groups copied tables by FKs of the merged db and of the destination
+          db, whose constraints are checked while copying
+
+          @return tuple (list of lists of table names, set of broken table names)
+        """
+        return dependency_waves(merge_fks(self._db_map, self._destination_db_map), tables)
+
+    def get_copy_fk_checks(self, table_name, broken):
+        """
+          Whether FK checks are enabled while copying the table. Tables which
+          can't be copied after all the tables they reference are copied
+          with FK checks disabled.
+        """
+        return self._config.copy_fk_checks and table_name not in broken
+
+    def copy_data_in_parallel(self, waves, broken):
+        """
+          Copies tables on copy_workers connections at the same time, biggest
+          tables first. Tables of a dependency wave are only started after all
+          the tables of the previous waves are copied. Tables with more than
+          copy_split_rows rows and a single numeric PK are split into
+          copy_split_ranges PK ranges copied at the same time. Every table (range) is copied in its own transaction and
+          committed when done, the number of copied rows is then verified
+          against the merged db. Workers can only see committed changes, so
+          the merged db is committed first - it won't be rolled back on error.
+        """
+        self._logger.log("----> Committing the merged db before copying on %d connections" % self._config.copy_workers)
+        self._conn.commit()
+
+        try:
+            shifted_pks = self.get_shifted_pks()
+            stats = self.get_table_stats()
+            copier = ParallelCopier(self._logger, self._config.copy_workers, self.get_worker_connections,
+                                    self._config.copy_retries,
+                                    lambda job_name: self._journal and self._journal.mark_done("copy:%s" % job_name))
+            job_tables = {}
+            resumed = set()
+            for wave_number, wave in enumerate(waves):
+                for table_name in wave:
+                    columns = self.get_copy_columns(table_name)
+                    fk_checks = self.get_copy_fk_checks(table_name, broken)
+                    size, rows = stats.get(table_name, (0, 0))
+                    # A table split by a previous run is split again - PKs didn't change since
+                    split = rows > self._config.copy_split_rows > 0 or \
+                            (self._journal and len(self._journal.get_done("copy:%s [" % table_name)))
+                    ranges = self.get_copy_ranges(table_name) if split else [None]
+                    for number, condition in enumerate(ranges, 1):
+                        job_name = table_name if len(ranges) == 1 else "%s [%d/%d]" % (table_name, number, len(ranges))
+                        if self.is_copied(job_name):
+                            self._logger.log("----> `%s` was copied in a previous run, skipping" % job_name)
+                            resumed.add(table_name)
+                            continue
+                        job_tables[job_name] = table_name
+                        select_query = self.get_copy_select(table_name, columns, shifted_pks, condition)
+                        copier.add_job(job_name, size / len(ranges),
+                                       self._get_copy_job(table_name, columns, select_query, fk_checks), wave_number)
+
+            copied = defaultdict(int)
+            for job_name, rows_count in copier.run().items():
+                copied[job_tables[job_name]] += rows_count
+            # Rows copied by a previous run are not counted, upserts count updated rows twice
+            if not self._config.incremental:
+                self.verify_copied_rows(dict((table_name, rows_count) for table_name, rows_count in copied.items()
+                                             if table_name not in resumed))
+        except Exception, e:
+            handle_exception("There was an error while moving data between databases", e, self._conn)
+
+    def _get_copy_job(self, table_name, columns, select_query, fk_checks):
+        if self._execution_mode == ExecutionMode.STREAM:
+            columns_descriptor = [self._db_map[table_name]['columns'][x] for x in columns]
+
+            def copy(connections):
+                self._set_worker_fk_checks(connections, fk_checks)
+                copier = StreamCopier(connections['source'], connections['destination'], self._logger,
+                                      self._config.batch_size, self._config.batch_max_bytes,
+                                      adaptive=self._config.adaptive_batch_size, upsert=self._config.incremental)
+                return copier.copy(table_name, columns_descriptor, select_query)
+        else:
+            query = self.get_insert_select_query(table_name, columns, select_query)
+
+            def copy(connections):
+                self._set_worker_fk_checks(connections, fk_checks)
+                cur = connections['destination'].cursor()
+                try:
+                    cur.execute(query)
+                    return cur.rowcount
+                finally:
+                    cur.close()
+        return copy
+
+    def _set_worker_fk_checks(self, connections, fk_checks):
+        cur = connections['destination'].cursor()
+        cur.execute("set foreign_key_checks=%d" % fk_checks)
+        cur.close()
+
+    def get_worker_connections(self):
+        """
+          Returns connections of a single copy worker. In DEFAULT mode data is
+          copied by INSERT ... SELECT on the destination connection alone.
+        """
+        connections = {'source': None, 'destination': create_connection(self._destination_db)}
+        cur = connections['destination'].cursor()
+        cur.execute("set names utf8")
+        cur.execute("set foreign_key_checks=0")
+        if self._config.bulk_load:
+            cur.execute("set unique_checks=0")
+        cur.close()
+        if self._execution_mode == ExecutionMode.STREAM:
+            connections['source'] = create_connection(self._source_db)
+            cur = connections['source'].cursor()
+            cur.execute("set names utf8")
+            cur.close()
+        return connections
+
+    def get_table_stats(self):
+        """
+          @return dict of table name -> tuple (DATA_LENGTH, estimated number of rows) of merged db tables
+        """
+        cur = self._conn.cursor()
+        cur.execute("SELECT TABLE_NAME, DATA_LENGTH, TABLE_ROWS FROM information_schema.TABLES " \
+                    "WHERE TABLE_SCHEMA = %s", (self._source_db['db'],))
+        stats = dict((row['TABLE_NAME'], (row['DATA_LENGTH'] or 0, row['TABLE_ROWS'] or 0)) for row in cur.fetchall())
+        cur.close()
+        return stats
+
+    def get_table_sizes(self):
+        """
+          @return dict of table name -> DATA_LENGTH of merged db tables which are copied
+        """
+        return dict((table_name, size) for table_name, (size, rows) in self.get_table_stats().items()
+                    if table_name in self._db_map)
+
+    def get_copy_ranges(self, table_name):
+        """
+          Splits values of the PK into copy_split_ranges ranges of equal width.
+          Tables without a single numeric PK are not split.
+
+          @return list of conditions
+        """
+        pks = self._db_map[table_name]['primary'].keys()
+        if len(pks) != 1:
+            return [None]
+
+        source_pk = "`%s`.`%s`.`%s`" % (self._source_db['db'], table_name, pks[0])
+        cur = self._conn.cursor()
+        cur.execute("SELECT MIN(%(pk)s) AS min_pk, MAX(%(pk)s) AS max_pk FROM `%(db)s`.`%(table)s`" % {
+            'pk': source_pk, 'db': self._source_db['db'], 'table': table_name})
+        row = cur.fetchone()
+        cur.close()
+        if row['min_pk'] is None:
+            return [None]
+
+        min_pk, max_pk = int(row['min_pk']), int(row['max_pk'])
+        width = max((max_pk - min_pk) / self._config.copy_split_ranges + 1, 1)
+        return ["%s BETWEEN %d AND %d" % (source_pk, start, min(start + width - 1, max_pk))
+                for start in xrange(min_pk, max_pk + 1, width)]
+
+    def verify_copied_rows(self, copied):
+        """
+          Compares the number of rows copied to each table with the number of
+          rows the merged db should have given
+        """
+        cur = self._conn.cursor()
+        mismatched = []
+        for table_name, rows_count in sorted(copied.items()):
+            cur.execute("SELECT COUNT(*) AS cnt FROM `%s`.`%s` %s" % (
+                self._source_db['db'], table_name, self.get_copy_where(table_name)))
+            expected = cur.fetchone()['cnt']
+            if expected != rows_count:
+                mismatched.append("%s (%d of %d rows)" % (table_name, rows_count, expected))
+        cur.close()
+
+        if len(mismatched):
+            raise Exception("Number of copied rows doesn't match for: %s" % ", ".join(mismatched))
+        self._logger.log("----> Verified number of rows of %d copied tables" % len(copied))
+
+    def export_to_outfile(self, table_name, columns, select_query, patch):
+        """
+          Makes the source server write rows of select_query to a TSV file and
+          writes a LOAD DATA INFILE statement reading it to the patch file.
+          Row data never goes through this process.
+
+          @return number of exported rows
+        """
+        # INTO OUTFILE refuses to overwrite files, those of previous runs are left alone
+        file_name = "%s-%s-%s.tsv" % (self._source_db['db'], table_name, self._run_id)
+        export_path = "%s/%s" % (self._config.outfile_dir.rstrip("/"), file_name)
+        load_path = "%s/%s" % ((self._config.outfile_load_dir or self._config.outfile_dir).rstrip("/"), file_name)
+
+        # Default FIELDS/LINES options of both statements are the same: tab
+        # separated, backslash escaped, \N for NULL
+        cur = self._cursor.execute("%s INTO OUTFILE %s CHARACTER SET utf8" % (select_query, self._conn.literal(export_path)))
+        rows_count = cur.rowcount
+        self._logger.log("----> `%s`: %d rows exported to %s" % (table_name, rows_count, export_path))
+
+        patch.write_line("LOAD DATA INFILE %s INTO TABLE `%s` CHARACTER SET utf8 (%s);" % (
+            self._conn.literal(load_path), table_name, ", ".join("`%s`" % column for column in columns)))
+
+        return rows_count
 
     def get_increment_value(self, table_name):
         if table_name in self._config.increment_step:
@@ -391,7 +1346,25 @@ class Merger(object):
             increment_step = self._config.increment_step['default']
         return self._counter * increment_step
 
+    def get_stream_copier(self):
+        # A journaled table is committed as a whole, so it can be copied again after a failure
+        commit_rows = self._config.bulk_load_commit_rows if self._config.bulk_load and not self._journal else None
+        return StreamCopier(self._conn, self.get_destination_connection(), self._logger, self._config.batch_size,
+                            self._config.batch_max_bytes, commit_rows, self._config.adaptive_batch_size,
+                            self._config.incremental)
+
+    def get_parent_tables(self, table_name):
+        """
+          Returns tables referenced by FKs (real or mapped) of the table
+
+          @return set of strings
+        """
+        table_map = self._db_map[table_name]
+        fks = table_map['fk_host'].values() + table_map['fk_create'].values()
+        return set(fk_data['parent'] for fk_data in fks if fk_data['parent'] != table_name)
+
     def get_patch_file(self):
         if not self._patch_file:
-            self._patch_file = PatchFileHelper(self._counter)
+            self._patch_file = PatchFileHelper(self._counter, self._config.patch_compression,
+                                               self._config.patch_per_table, self._config.patch_buffer_size)
         return self._patch_file
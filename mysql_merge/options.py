@@ -0,0 +1,65 @@
+import mysql_merge.config
+from mysql_merge.modes import ExecutionMode, PkShiftMode
+
+# Options added after the first config.py files were written, with the values
+# given to them in config.py.example
+DEFAULTS = {
+    'orphans_chunk_size': 100000,
+    'schema_cache_dir': '.schema_cache',
+    'pk_shift_mode': PkShiftMode.UPDATE,
+    'pk_shift_chunk_size': 100000,
+    'pk_shift_commit_chunks': False,
+    'parallel_sources': 1,
+    'checkpoint_dir': None,
+    'single_pass_copy': False,
+    'incremental': False,
+    'incremental_columns': {},
+    'incremental_state_file': '.merge_watermarks.json',
+    'copy_workers': 1,
+    'copy_split_rows': 10000000,
+    'copy_split_ranges': 8,
+    'copy_retries': 2,
+    'batch_max_bytes': 1048576 * 4,
+    'adaptive_batch_size': False,
+    'unique_conflict_hash_index': False,
+    'unique_conflict_memory_budget': 1048576 * 256,
+    'unique_conflict_normalize': True,
+    'copy_fk_checks': True,
+    'bulk_load': False,
+    'bulk_load_drop_indexes_size': None,
+    'bulk_load_commit_rows': 100000,
+    'patch_compression': None,
+    'patch_per_table': False,
+    'patch_buffer_size': 1048576 * 8,
+    'outfile_dir': '/var/lib/mysql-files',
+    'outfile_load_dir': None,
+    'replay_workers': 4,
+    'replay_commit_every': 100,
+}
+
+
+class Options(object):
+    """
+      Reads options of a config module. Options missing in config files
+      written for older versions get their DEFAULTS. Modes are read by name,
+      as older config files define an ExecutionMode enum of their own.
+    """
+    _module = None
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, name):
+        if name in DEFAULTS:
+            value = getattr(self._module, name, DEFAULTS[name])
+        else:
+            value = getattr(self._module, name)
+
+        if name == 'execution_mode':
+            return ExecutionMode[value.name]
+        if name == 'pk_shift_mode':
+            return PkShiftMode[value.name]
+        return value
+
+
+config = Options(mysql_merge.config)
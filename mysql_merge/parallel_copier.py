@@ -0,0 +1,131 @@
+import threading
+import time
+import Queue
+
+
+class ParallelCopier(object):
+    """
+      Runs copy jobs on a pool of worker connections, wave by wave and
+      biggest jobs first within a wave.
+      Every job runs in its own transaction on the destination connection
+      of a worker and is committed as soon as it is done. A failed job is
+      rolled back and retried on new connections up to retries times, after
+      its last failure no new jobs are started.
+    """
+    _logger = None
+    _workers = None
+    _connect = None
+    _retries = 0
+    _on_done = None
+
+    def __init__(self, logger, workers, connect, retries=0, on_done=None):
+        """
+          connect - callable returning a dict of new connections for a worker,
+                    the 'destination' one is committed after every job
+          on_done - callable receiving the name of every committed job
+        """
+        self._logger = logger
+        self._workers = max(workers, 1)
+        self._connect = connect
+        self._retries = retries
+        self._on_done = on_done
+        self._jobs = []
+        self._results = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._failed = threading.Event()
+
+    def add_job(self, name, size, copy, wave=0):
+        """
+          copy - callable receiving the worker connections, returning the number of copied rows
+          wave - jobs of a wave are started once all jobs of lower waves are done
+        """
+        self._jobs.append((wave, size, name, copy))
+
+    def run(self):
+        """
+          @return dict of job name -> number of copied rows
+        """
+        for wave in sorted(set(job[0] for job in self._jobs)):
+            if self._failed.is_set():
+                break
+            jobs = sorted([job for job in self._jobs if job[0] == wave], reverse=True)
+            queue = Queue.Queue()
+            for _, size, name, copy in jobs:
+                queue.put((name, copy))
+
+            threads = []
+            for _ in range(min(self._workers, len(jobs))):
+                thread = threading.Thread(target=self._work, args=(queue,))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+
+        if len(self._errors):
+            raise Exception("Copying failed for: %s. Copied and committed: %s" % (
+                "; ".join("%s (%s)" % (name, e) for name, e in sorted(self._errors.items())),
+                ", ".join(sorted(self._results)) or "nothing"))
+
+        return self._results
+
+    def _work(self, queue):
+        connections = {}
+        try:
+            connections = self._connect()
+            while not self._failed.is_set():
+                try:
+                    name, copy = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                connections = self._run_job(connections, name, copy)
+        except BaseException, e:
+            # Connecting goes through handle_exception, which exits
+            self._fail("worker connection", e)
+        finally:
+            self._close(connections)
+
+    def _close(self, connections):
+        for conn in connections.values():
+            if conn:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    def _run_job(self, connections, name, copy):
+        """
+          @return connections to be used by the next job
+        """
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                rows_count = copy(connections)
+                connections['destination'].commit()
+                break
+            except Exception, e:
+                # Closing the connection rolls the transaction back, the
+                # connection may also be the reason of the failure
+                self._close(connections)
+                connections = {}
+                if attempt >= self._retries or self._failed.is_set():
+                    self._fail(name, e)
+                    return connections
+                attempt += 1
+                self._logger.log("----> `%s`: %s, retrying (%d/%d)" % (name, e, attempt, self._retries))
+                connections = self._connect()
+
+        elapsed = time.time() - started
+        with self._lock:
+            self._results[name] = rows_count
+        if self._on_done:
+            self._on_done(name)
+        self._logger.log("----> `%s`: %d rows in %.2fs (%d rows/s)" % (
+            name, rows_count, elapsed, rows_count / elapsed if elapsed else rows_count))
+        return connections
+
+    def _fail(self, name, e):
+        with self._lock:
+            self._errors[name] = e
+        self._failed.set()
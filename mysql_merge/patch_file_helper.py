@@ -1,20 +1,134 @@
 from datetime import datetime
+import gzip
+import json
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class PatchFileHelper():
+    """
+      Writes the statements generated in IMPORT_FILE mode, optionally
+      compressed and optionally one file per table with a manifest.
+      Writes are buffered and passed to the file buffer_size bytes at a time.
+    """
     _file = None
+    _raw_file = None
+    _directory = None
+    _manifest = None
 
     PATCH_FILE_PATH_TEMPLATE = "patch-{num}-{timestamp}.sql"
+    PATCH_DIR_PATH_TEMPLATE = "patch-{num}-{timestamp}"
+    TABLE_FILE_PATH_TEMPLATE = "{table}.sql"
+    MANIFEST_FILE_PATH = "manifest.json"
+    EXTENSIONS = {None: "", 'gzip': ".gz", 'zstd': ".zst"}
+    PROLOGUE = 'SET FOREIGN_KEY_CHECKS = 0;'
+    EPILOGUE = 'SET FOREIGN_KEY_CHECKS = 1;'
+
+    def __init__(self, order=0, compression=None, per_table=False, buffer_size=1048576):
+        if compression not in self.EXTENSIONS:
+            raise Exception("Unknown patch file compression: %s" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise Exception("zstd compression of patch files requires the zstandard package")
+
+        self._compression = compression
+        self._per_table = per_table
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
 
-    def __init__(self, order=0):
         now = datetime.now()
-        self._file = open(self.PATCH_FILE_PATH_TEMPLATE.format(
-            timestamp=datetime.date(now), num=order), "w")
+        if per_table:
+            self._directory = self.PATCH_DIR_PATH_TEMPLATE.format(timestamp=datetime.date(now), num=order)
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            self._manifest = {
+                'compression': compression,
+                'tables': []
+            }
+        else:
+            self._open(self.PATCH_FILE_PATH_TEMPLATE.format(timestamp=datetime.date(now), num=order))
+            self.write_line(self.PROLOGUE)
+
+    def _open(self, path):
+        path += self.EXTENSIONS[self._compression]
+        if self._compression == 'gzip':
+            self._file = gzip.open(path, "wb")
+        elif self._compression == 'zstd':
+            self._raw_file = open(path, "wb")
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw_file)
+        else:
+            self._file = open(path, "wb")
+        return os.path.basename(path)
+
+    def _flush(self):
+        if self._buffered:
+            self._file.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _close_file(self):
+        if not self._file:
+            return
+
+        self._flush()
+        if self._raw_file:
+            self._file.flush(zstandard.FLUSH_FRAME)
+            self._raw_file.close()
+            self._raw_file = None
+        else:
+            self._file.close()
+        self._file = None
+
+    def _write_manifest(self):
+        with open(os.path.join(self._directory, self.MANIFEST_FILE_PATH), "w") as f:
+            json.dump(self._manifest, f, indent=2)
 
     def write_line(self, string):
-        self._file.write(string + os.linesep)
+        self._buffer.append(string)
+        self._buffer.append(os.linesep)
+        self._buffered += len(string) + len(os.linesep)
+        if self._buffered >= self._buffer_size:
+            self._flush()
+
+    def begin_table(self, table_name, depends_on=()):
+        """
+          Starts the file of a table (per_table mode only). depends_on lists
+          tables which should be loaded before this one.
+        """
+        if not self._per_table:
+            return
+
+        self._close_file()
+        file_name = self._open(os.path.join(self._directory, self.TABLE_FILE_PATH_TEMPLATE.format(table=table_name)))
+        self._manifest['tables'].append({
+            'table': table_name,
+            'file': file_name,
+            'depends_on': sorted(depends_on),
+            'rows': 0
+        })
+        self.write_line(self.PROLOGUE)
+
+    def end_table(self, rows):
+        if not self._per_table:
+            return
+
+        self.write_line(self.EPILOGUE)
+        self._close_file()
+        self._manifest['tables'][-1]['rows'] = rows
+        # Kept up to date after every table, so a partial export can be loaded too
+        self._write_manifest()
+
+    def close(self):
+        if self._per_table:
+            self._close_file()
+            self._write_manifest()
+        elif self._file:
+            self.write_line(self.EPILOGUE)
+            self._close_file()
 
     def __del__(self):
-        if self._file:
-            self._file.close()
+        self.close()
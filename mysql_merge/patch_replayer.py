@@ -0,0 +1,254 @@
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import Queue
+from collections import defaultdict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from mysql_merge.patch_file_helper import PatchFileHelper
+
+
+def open_patch(path):
+    """
+      Opens a patch file for reading, decompressing it by its extension
+    """
+    if path.endswith(PatchFileHelper.EXTENSIONS['gzip']):
+        return gzip.open(path, "rb")
+    if path.endswith(PatchFileHelper.EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise Exception("Reading %s requires the zstandard package" % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def read_statements(path, read_size=1048576):
+    """
+      Yields statements of a patch file. Escaped values never contain a raw
+      line break, so every line holds exactly one statement.
+    """
+    f = open_patch(path)
+    try:
+        pending = ""
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.rstrip("\r")
+                if line:
+                    yield line
+        if pending.rstrip("\r"):
+            yield pending.rstrip("\r")
+    finally:
+        f.close()
+
+
+class PatchReplayer(object):
+    """
+      Loads patches written in IMPORT_FILE mode over a pool of destination
+      connections. Each connection runs with unique and foreign key checks
+      disabled and commits every commit_every statements. All statements of
+      a table are executed by one connection, in the order of the file.
+    """
+    TABLE_PATTERN = re.compile(r"^(?:INSERT|REPLACE|LOAD DATA)\b.*? INTO (?:TABLE )?`([^`]+)`")
+    SESSION_QUERIES = ["set names utf8", "set unique_checks=0", "set foreign_key_checks=0"]
+    QUEUE_SIZE = 64
+
+    _connect = None
+    _logger = None
+    _workers = None
+    _commit_every = None
+    _error = None
+
+    def __init__(self, connect, logger, workers, commit_every):
+        """
+          connect - callable returning a new connection to the destination db
+        """
+        self._connect = connect
+        self._logger = logger
+        self._workers = max(workers, 1)
+        self._commit_every = max(commit_every, 1)
+        self._failed = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = defaultdict(lambda: [0, 0.0])
+
+    def get_table(self, statement):
+        """
+          @return name of the table a statement writes to, None for other statements
+        """
+        match = self.TABLE_PATTERN.match(statement)
+        return match.group(1) if match else None
+
+    def replay(self, path):
+        """
+          Replays a single patch file or a per-table patch directory
+
+          @return dict of table name -> number of loaded rows
+        """
+        started = time.time()
+        if os.path.isdir(path):
+            self._replay_directory(path)
+        else:
+            self._replay_file(path)
+
+        elapsed = time.time() - started
+        rows_count = sum(rows for rows, _ in self._stats.values())
+        self._logger.log("Loaded %d rows in %.2fs (%d rows/s)" % (
+            rows_count, elapsed, rows_count / elapsed if elapsed else rows_count))
+
+        return dict((table, rows) for table, (rows, _) in self._stats.items())
+
+    def _replay_file(self, path):
+        """
+          Statements are read by this thread and routed to the workers by
+          table name, so different tables are loaded concurrently
+        """
+        queues = [Queue.Queue(self.QUEUE_SIZE) for _ in range(self._workers)]
+        workers = self._start_workers(queues, self._execute_statement)
+        routes = {}
+        try:
+            for statement in read_statements(path):
+                if self._failed.is_set():
+                    break
+                if statement.upper().startswith("SET "):
+                    # Session settings are set by the replayer itself
+                    continue
+                table = self.get_table(statement)
+                if table not in routes:
+                    routes[table] = queues[len(routes) % len(queues)]
+                self._put(routes[table], (table, statement))
+        finally:
+            for queue in queues:
+                self._put(queue, None)
+            self._join(workers)
+
+        for table in sorted(routes):
+            if table is not None:
+                self._log_table(table)
+
+    def _replay_directory(self, path):
+        """
+          Every table file is loaded by a single worker, biggest tables first
+        """
+        with open(os.path.join(path, PatchFileHelper.MANIFEST_FILE_PATH)) as f:
+            manifest = json.load(f)
+
+        tables = sorted(manifest['tables'], key=lambda table: table['rows'], reverse=True)
+        jobs = Queue.Queue()
+        for table in tables:
+            jobs.put((table['table'], os.path.join(path, table['file']), table['rows']))
+        workers = self._start_workers([jobs] * self._workers, self._execute_file)
+        for _ in workers:
+            jobs.put(None)
+        self._join(workers)
+
+    def _start_workers(self, queues, handler):
+        workers = []
+        for queue in queues:
+            worker = threading.Thread(target=self._work, args=(queue, handler))
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def _join(self, workers):
+        for worker in workers:
+            worker.join()
+        if self._error:
+            raise self._error
+
+    def _put(self, queue, item):
+        # A failed worker stops consuming its queue, don't wait for it forever
+        while not self._failed.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def _get(self, queue):
+        """
+          @return next job, None when the queue is finished or another worker failed
+        """
+        while not self._failed.is_set():
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                pass
+        return None
+
+    def _work(self, queue, handler):
+        conn = None
+        try:
+            conn = self._connect()
+            cur = conn.cursor()
+            for query in self.SESSION_QUERIES:
+                cur.execute(query)
+            state = {'pending': 0}
+            while True:
+                job = self._get(queue)
+                if job is None:
+                    break
+                handler(conn, cur, state, job)
+            if self._failed.is_set():
+                conn.rollback()
+            else:
+                conn.commit()
+            cur.close()
+        except BaseException, e:
+            # Connecting goes through handle_exception, which exits
+            if not self._failed.is_set():
+                self._error = e
+                self._failed.set()
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
+    def _execute(self, conn, cur, state, table, statement):
+        started = time.time()
+        cur.execute(statement)
+        elapsed = time.time() - started
+        with self._stats_lock:
+            self._stats[table][0] += max(cur.rowcount, 0)
+            self._stats[table][1] += elapsed
+
+        state['pending'] += 1
+        if state['pending'] >= self._commit_every:
+            conn.commit()
+            state['pending'] = 0
+
+    def _execute_statement(self, conn, cur, state, job):
+        table, statement = job
+        self._execute(conn, cur, state, table, statement)
+
+    def _execute_file(self, conn, cur, state, job):
+        table, path, expected_rows = job
+        for statement in read_statements(path):
+            if self._failed.is_set():
+                return
+            if statement.upper().startswith("SET "):
+                continue
+            self._execute(conn, cur, state, table, statement)
+        conn.commit()
+        state['pending'] = 0
+
+        rows_count = self._log_table(table)
+        if rows_count != expected_rows:
+            self._logger.log("----> `%s`: expected %d rows according to the manifest" % (table, expected_rows))
+
+    def _log_table(self, table):
+        with self._stats_lock:
+            rows_count, elapsed = self._stats[table]
+        self._logger.log("----> `%s`: %d rows in %.2fs (%d rows/s)" % (
+            table, rows_count, elapsed, rows_count / elapsed if elapsed else rows_count))
+        return rows_count
@@ -0,0 +1,30 @@
+import MySQLdb.cursors
+
+
+def stream_rows(conn, query, fetch_size):
+    """
+      Yields rows of query as tuples. Rows are read with an unbuffered
+      server-side cursor, fetch_size at a time, so the result set is never
+      held in client memory. No other query can run on conn until the
+      generator is exhausted or closed.
+    """
+    cur = conn.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cur.close()
+
+
+def escape_rows(conn, rows):
+    """
+      Yields rows as tuples of SQL literals, escaped by conn a whole row at a time
+    """
+    literal = conn.literal
+    for row in rows:
+        yield literal(row)
@@ -0,0 +1,45 @@
+import cPickle
+import os
+import tempfile
+
+
+class SchemaMapCache(object):
+    """
+      Stores mapped schemas on disk, keyed by a fingerprint of the schema.
+      A map is written to a temporary file and renamed, so concurrent
+      writers never leave a truncated cache entry behind.
+    """
+    VERSION = 3
+    FILE_TEMPLATE = "schema-{fingerprint}.map"
+
+    _directory = None
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _get_path(self, fingerprint):
+        return os.path.join(self._directory, self.FILE_TEMPLATE.format(fingerprint=fingerprint))
+
+    def load(self, fingerprint):
+        """
+          Returns cached db_map or None if there is no entry for the fingerprint
+        """
+        path = self._get_path(fingerprint)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                return cPickle.load(f)
+        except Exception:
+            # A broken entry is just a cache miss
+            return None
+
+    def save(self, fingerprint, db_map):
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump(db_map, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._get_path(fingerprint))
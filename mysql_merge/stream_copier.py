@@ -0,0 +1,88 @@
+import time
+from mysql_merge.adaptive_batch_sizer import AdaptiveBatchSizer
+from mysql_merge.insert_query_composer import InsertQueryComposer
+from mysql_merge.row_stream import stream_rows, escape_rows
+
+
+class StreamCopier(object):
+    """
+      Copies rows between two connections, which may point to different
+      servers. Rows are read with an unbuffered server-side cursor and
+      written to the destination as multi-row INSERTs, so memory use is
+      bounded by a single batch whatever the size of the table.
+    """
+    _source_conn = None
+    _destination_conn = None
+    _destination_cur = None
+    _logger = None
+    _batch_size = None
+    _batch_max_bytes = None
+    _commit_rows = None
+    _adaptive = False
+    _upsert = False
+    _bytes_count = 0
+    _uncommitted_rows = 0
+
+    def __init__(self, source_conn, destination_conn, logger, batch_size, batch_max_bytes=None, commit_rows=None,
+                 adaptive=False, upsert=False):
+        """
+          commit_rows - commit the destination connection every time that many rows are written
+          adaptive    - size INSERTs by measured throughput up to max_allowed_packet of the
+                        destination instead of batch_size/batch_max_bytes
+          upsert      - update rows which already exist in the destination
+        """
+        self._source_conn = source_conn
+        self._destination_conn = destination_conn
+        self._logger = logger
+        self._batch_size = max(batch_size, 1)
+        self._batch_max_bytes = batch_max_bytes
+        self._commit_rows = commit_rows
+        self._adaptive = adaptive
+        self._upsert = upsert
+
+    def _execute(self, query):
+        self._destination_cur.execute(query)
+        self._bytes_count += len(query)
+        if self._commit_rows:
+            self._uncommitted_rows += self._destination_cur.rowcount
+            if self._uncommitted_rows >= self._commit_rows:
+                self._destination_conn.commit()
+                self._uncommitted_rows = 0
+
+    def copy(self, table_name, columns_descriptor, select_query):
+        """
+          Streams rows returned by select_query (run on the source) into
+          table_name (on the destination).
+
+          @return number of copied rows
+        """
+        self._destination_cur = self._destination_conn.cursor()
+        if self._adaptive:
+            sizer = AdaptiveBatchSizer.for_connection(self._destination_conn)
+            query_composer = InsertQueryComposer(table_name, columns_descriptor, self._execute, sizer=sizer,
+                                                 upsert=self._upsert)
+        else:
+            sizer = None
+            query_composer = InsertQueryComposer(table_name, columns_descriptor, self._execute,
+                                                 self._batch_size, self._batch_max_bytes, upsert=self._upsert)
+
+        rows_count = self._bytes_count = 0
+        started = time.time()
+        try:
+            rows = stream_rows(self._source_conn, select_query, self._batch_size)
+            for values in escape_rows(self._destination_conn, rows):
+                query_composer.add_value(values)
+                rows_count += 1
+            query_composer.flush()
+        finally:
+            self._destination_cur.close()
+
+        elapsed = time.time() - started
+        self._logger.log("----> `%s`: %d rows, %.1f MB in %.2fs (%d rows/s, %.1f MB/s)" % (
+            table_name, rows_count, self._bytes_count / 1048576.0, elapsed,
+            rows_count / elapsed if elapsed else rows_count,
+            self._bytes_count / 1048576.0 / elapsed if elapsed else 0))
+        if sizer:
+            self._logger.log("----> `%s`: batches: %s" % (table_name, sizer.get_summary()))
+
+        return rows_count
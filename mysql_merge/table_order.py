@@ -0,0 +1,97 @@
+def get_parents(db_map, tables):
+    """
+      Returns tables referenced by FKs (real or mapped) of every table,
+      limited to the given tables. Self references are left out.
+
+      @return dict of table name -> set of table names
+    """
+    parents = {}
+    for table_name in tables:
+        table_map = db_map[table_name]
+        fks = table_map['fk_host'].values() + table_map['fk_create'].values()
+        parents[table_name] = set(fk_data['parent'] for fk_data in fks
+                                  if fk_data['parent'] in tables and fk_data['parent'] != table_name)
+    return parents
+
+
+def merge_fks(*db_maps):
+    """
+      Returns a map of FKs (real or mapped) found in any of the maps, e.g. of
+      a merged db and of the destination db, whose constraints are the ones
+      checked when rows are copied. The first map wins for the same column.
+
+      @return dict of table name -> dict with 'fk_host' and 'fk_create'
+    """
+    merged = {}
+    for db_map in db_maps:
+        for table_name, table_map in db_map.items():
+            fks = merged.setdefault(table_name, {'fk_host': {}, 'fk_create': {}})
+            for key in ('fk_host', 'fk_create'):
+                for col_name, fk_data in table_map[key].items():
+                    fks[key].setdefault(col_name, fk_data)
+    return merged
+
+
+def is_self_referencing(db_map, table_name):
+    table_map = db_map[table_name]
+    fks = table_map['fk_host'].values() + table_map['fk_create'].values()
+    return any(fk_data['parent'] == table_name for fk_data in fks)
+
+
+def _in_cycle(parents, table_name, remaining):
+    # Whether the table can be reached again by following its references
+    stack = list(parents[table_name] & remaining)
+    visited = set()
+    while stack:
+        current = stack.pop()
+        if current == table_name:
+            return True
+        if current in visited:
+            continue
+        visited.add(current)
+        stack.extend(parents[current] & remaining)
+    return False
+
+
+def dependency_waves(db_map, tables=None):
+    """
+      Groups tables into waves - every table references only tables of the
+      previous waves, tables of one wave can be loaded at the same time.
+
+      Rows of a self-referencing table can't be loaded in an arbitrary order
+      with FK checks enabled. Cycles are broken by ignoring references of
+      the table with the fewest unresolved ones. Both kinds of tables are
+      returned as broken - they have to be loaded with FK checks disabled.
+
+      @return tuple (list of lists of table names, set of broken table names)
+    """
+    tables = set(db_map.keys() if tables is None else tables)
+    parents = get_parents(db_map, tables)
+    broken = set(table_name for table_name in tables if is_self_referencing(db_map, table_name))
+
+    waves = []
+    done = set()
+    remaining = set(tables)
+    while remaining:
+        wave = sorted(table_name for table_name in remaining if parents[table_name] <= done)
+        if not len(wave):
+            in_cycle = [table_name for table_name in remaining if _in_cycle(parents, table_name, remaining)]
+            table_name = min(in_cycle, key=lambda t: (len(parents[t] - done), t))
+            broken.add(table_name)
+            wave = [table_name]
+
+        waves.append(wave)
+        done.update(wave)
+        remaining.difference_update(wave)
+
+    return waves, broken
+
+
+def dependency_order(db_map, tables=None):
+    """
+      Returns tables ordered so referenced tables come first
+
+      @return tuple (list of table names, set of broken table names)
+    """
+    waves, broken = dependency_waves(db_map, tables)
+    return [table_name for wave in waves for table_name in wave], broken
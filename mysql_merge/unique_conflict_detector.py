@@ -0,0 +1,180 @@
+import binascii
+import hashlib
+import os
+import sqlite3
+import struct
+import tempfile
+
+
+class UniqueConflictDetector(object):
+    """
+      Finds rows of a merged db whose unique index values already exist in
+      a destination table, without joining the two - so the destination db
+      can live on another server. Unique tuples of the destination table are
+      read once for all its unique indexes and kept as md5 digests mapped to
+      the destination PK. Source rows are then probed against them.
+
+      Digests are kept in a dict while it fits memory_budget (bytes). Beyond
+      that they are spilled to a temporary sqlite file and the budget is
+      given to a Bloom filter, so most source rows, which don't conflict,
+      are still answered from memory.
+
+      With normalize, strings are compared lowercased and without trailing
+      spaces, like the default _ci collations of MySQL do. NULLs never
+      conflict.
+    """
+    # Approximate size of one dict entry - a 16 bytes digest, a PK and a slot
+    ENTRY_SIZE = 150
+    BLOOM_HASHES = 4
+    SPILL_BATCH = 10000
+
+    _indexes = None
+    _memory_budget = None
+    _normalize = True
+
+    def __init__(self, indexes, memory_budget, normalize=True):
+        """
+          @param indexes dict of index name -> list of columns
+        """
+        self._indexes = indexes
+        self._memory_budget = memory_budget
+        self._normalize = normalize
+        self._digests = {}
+        self._db = None
+        self._db_path = None
+        self._pending = []
+        self._bloom = None
+        self._bloom_bits = 0
+
+    def get_columns(self):
+        """
+          @return list of all columns of the unique indexes, each one once
+        """
+        columns = []
+        for index_columns in self._indexes.values():
+            columns.extend(column for column in index_columns if column not in columns)
+        return columns
+
+    def load(self, rows):
+        """
+          Indexes destination rows - tuples of the PK followed by values of get_columns()
+
+          @return number of rows read
+        """
+        columns = self.get_columns()
+        positions = dict((index_name, [columns.index(column) + 1 for column in index_columns])
+                         for index_name, index_columns in self._indexes.items())
+        count = 0
+        for row in rows:
+            count += 1
+            for index_name, index_positions in positions.items():
+                digest = self._digest(index_name, [row[position] for position in index_positions])
+                if digest is not None:
+                    self._add(digest, row[0])
+
+        self._flush()
+        return count
+
+    def find(self, index_name, rows):
+        """
+          Probes merged db rows - tuples of the PK followed by values of the
+          index columns - against the destination tuples of the index
+
+          @return list of tuples (merged db PK, destination PK)
+        """
+        pairs = []
+        for row in rows:
+            digest = self._digest(index_name, row[1:])
+            if digest is None:
+                continue
+            pk = self._get(digest)
+            if pk is not None:
+                pairs.append((row[0], pk))
+        return pairs
+
+    def is_spilled(self):
+        return self._db is not None
+
+    def close(self):
+        """
+          Frees the digests and removes the spill file
+        """
+        self._digests = {}
+        self._bloom = None
+        if self._db:
+            self._db.close()
+            self._db = None
+            os.remove(self._db_path)
+
+    def _digest(self, index_name, values):
+        parts = []
+        for value in values:
+            if value is None:
+                return None
+            parts.append(self._normalize_value(value))
+        return hashlib.md5(u"\x00".join([index_name] + parts).encode('utf8')).digest()
+
+    def _normalize_value(self, value):
+        if isinstance(value, str):
+            try:
+                value = value.decode('utf8')
+            except UnicodeDecodeError:
+                # Binary data is compared as it is
+                return u"0x" + binascii.hexlify(value)
+        if isinstance(value, unicode):
+            return value.rstrip(u" ").lower() if self._normalize else value
+        return unicode(value)
+
+    def _add(self, digest, pk):
+        if self._db is None:
+            self._digests.setdefault(digest, pk)
+            if len(self._digests) * self.ENTRY_SIZE > self._memory_budget:
+                self._spill()
+            return
+
+        self._bloom_add(digest)
+        self._pending.append((binascii.hexlify(digest), pk))
+        if len(self._pending) >= self.SPILL_BATCH:
+            self._flush()
+
+    def _get(self, digest):
+        if self._db is None:
+            return self._digests.get(digest)
+
+        if not self._bloom_contains(digest):
+            return None
+        row = self._db.execute("SELECT pk FROM tuples WHERE digest = ?", (binascii.hexlify(digest),)).fetchone()
+        return row[0] if row else None
+
+    def _spill(self):
+        fd, self._db_path = tempfile.mkstemp(prefix='dbmerge-unique-', suffix='.sqlite')
+        os.close(fd)
+        self._db = sqlite3.connect(self._db_path)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE tuples (digest TEXT PRIMARY KEY, pk INTEGER NOT NULL)")
+
+        self._bloom_bits = max(self._memory_budget, 1024) * 8
+        self._bloom = bytearray(self._bloom_bits // 8)
+        digests = self._digests
+        self._digests = {}
+        for digest, pk in digests.iteritems():
+            self._add(digest, pk)
+
+    def _flush(self):
+        if self._db is None or not len(self._pending):
+            return
+        # The first destination row of a tuple wins, as it does in the dict
+        self._db.executemany("INSERT OR IGNORE INTO tuples (digest, pk) VALUES (?, ?)", self._pending)
+        self._db.commit()
+        self._pending = []
+
+    def _bloom_positions(self, digest):
+        return [value % self._bloom_bits for value in struct.unpack("<%dI" % self.BLOOM_HASHES, digest)]
+
+    def _bloom_add(self, digest):
+        for position in self._bloom_positions(digest):
+            self._bloom[position >> 3] |= 1 << (position & 7)
+
+    def _bloom_contains(self, digest):
+        return all(self._bloom[position >> 3] & (1 << (position & 7)) for position in self._bloom_positions(digest))
@@ -2,11 +2,13 @@ import MySQLdb
 import MySQLdb.cursors
 import _mysql_exceptions
 import sys
+import threading
 import traceback
 from mysql_merge.levenshtein import levenshtein_lowest
 from mysql_merge.config import default_mapping, ignore_unlisted, verbose
 
 qs = ""
+cleanups = []
 
 
 class MiniLogger(object):
@@ -48,6 +50,20 @@ def create_connection(connection, common_data={}):
 logger = MiniLogger()
 
 
+def register_cleanup(callback):
+    """
+      Registers a callable run by handle_exception (in the same thread) after
+      the rollback, e.g. to restore the destination db to its original state
+    """
+    cleanups.append((threading.current_thread(), callback))
+
+
+def unregister_cleanup(callback):
+    for cleanup in list(cleanups):
+        if cleanup[1] == callback:
+            cleanups.remove(cleanup)
+
+
 def handle_exception(custom_message, exception, connection=None):
     print ""
     print "-----------------------------------------------"
@@ -63,6 +79,13 @@ def handle_exception(custom_message, exception, connection=None):
     if connection:
         print "Rollback"
         connection.rollback()
+    for thread, callback in reversed(list(cleanups)):
+        if thread == threading.current_thread():
+            print "Running cleanup %s" % callback.__name__
+            try:
+                callback()
+            except Exception, e:
+                print "Cleanup failed: %s" % e
     print ""
     sys.exit()
 
@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+
+
+class WatermarkStore(object):
+    """
+      Keeps watermarks of incremental merges in a local JSON file:
+      { db name: { table name: { 'column': column, 'value': value } } }
+      Values are the highest ones copied so far, in terms of the merged db
+      before its PKs are shifted. Each save re-reads the file, so merges of
+      several dbs running at the same time don't overwrite each other.
+    """
+    _lock = threading.Lock()
+    _path = None
+
+    def __init__(self, path):
+        self._path = path
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return {}
+        with open(self._path) as f:
+            return json.load(f)
+
+    def load(self, db_name):
+        """
+          @return dict of table name -> dict with 'column' and 'value'
+        """
+        with self._lock:
+            return self._read().get(db_name, {})
+
+    def save(self, db_name, watermarks):
+        """
+          Updates watermarks of the given tables of the db
+        """
+        with self._lock:
+            data = self._read()
+            data.setdefault(db_name, {}).update(watermarks)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self._path)
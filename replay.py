@@ -0,0 +1,29 @@
+import sys
+import copy
+
+from mysql_merge.utils import MiniLogger, create_connection, handle_exception
+from mysql_merge.patch_replayer import PatchReplayer
+from mysql_merge.options import config
+
+# Loads patch files or per-table patch directories written in
+# ExecutionMode.IMPORT_FILE into config.destination_db
+if len(sys.argv) < 2:
+  print "Usage: python replay.py <patch file or directory> [<patch file or directory> ...]"
+  sys.exit()
+
+destination_db_tpl = copy.deepcopy(config.common_data)
+destination_db_tpl.update(config.destination_db)
+
+def connect():
+  return create_connection(destination_db_tpl)
+
+for path in sys.argv[1:]:
+  print "Replaying %s" % path
+  try:
+    replayer = PatchReplayer(connect, MiniLogger(), config.replay_workers, config.replay_commit_every)
+    replayer.replay(path)
+  except Exception, e:
+    handle_exception("There was an unexpected error while replaying %s" % path, e)
+  print ""
+
+print "Replay is finished"
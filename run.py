@@ -1,17 +1,29 @@
 import sys
 import copy
+import threading
 import traceback
 from collections import defaultdict
 
 from mysql_merge.utils import MiniLogger, create_connection, handle_exception, map_fks
 from mysql_merge.mysql_mapper import Mapper
 from mysql_merge.mysql_merger import Merger
-import mysql_merge.config as config
+from mysql_merge.multi_source_copier import MultiSourceCopier
+from mysql_merge.options import config
+from mysql_merge.modes import ExecutionMode, PkShiftMode
+
+# --resume continues merges recorded in checkpoint journals (config.checkpoint_dir)
+resume = "--resume" in sys.argv[1:]
 
 # VALIDATE CONFIG:
 if len(config.merged_dbs) == 0:
   print "You must specify at least one database to merge"
   sys.exit()
+
+single_pass = config.single_pass_copy and config.execution_mode == ExecutionMode.DEFAULT
+if single_pass and config.pk_shift_mode != PkShiftMode.SELECT and not config.checkpoint_dir:
+  # All the dbs are committed with incremented PKs before copying, a failure could not be undone
+  print "single_pass_copy requires pk_shift_mode = PkShiftMode.SELECT or checkpoint_dir to resume failed merges"
+  sys.exit()
   
 # Prepare logger
 
@@ -24,8 +36,8 @@ print " -> 1.1 First merged db"
 mapped_db = config.merged_dbs[0]
 conn = create_connection(mapped_db, config.common_data)
 
-mapper = Mapper(conn, mapped_db['db'], MiniLogger())
-db_map = mapper.map_db()
+source_mapper = Mapper(conn, mapped_db['db'], MiniLogger())
+db_map = source_mapper.map_db()
 
 conn.close()
 
@@ -33,8 +45,9 @@ print " -> 1.2 Destination db"
 
 conn = create_connection(config.destination_db, config.common_data)
 
-mapper = Mapper(conn, config.destination_db['db'], MiniLogger())
+mapper = Mapper(conn, config.destination_db['db'], MiniLogger(), role='destination')
 destination_db_map = mapper.map_db()
+mapper.save_cache()
 
 conn.close()
 
@@ -43,27 +56,97 @@ conn.close()
 print ""
 print "STEP 2. Map all the fields that looks like FKs but aren't stored as ones"
 map_fks(db_map)
+source_mapper.save_cache()
 
 
-print ""
-print "STEP 3. Actually merge all the databases"
-print ""
-counter = 0
-for source_db in config.merged_dbs:
- counter = counter + 1
- try:
+destination_db_tpl = copy.deepcopy(config.common_data)
+destination_db_tpl.update(config.destination_db)
+
+
+def create_merger(counter, source_db):
   source_db_tpl = copy.deepcopy(config.common_data)
   source_db_tpl.update(source_db)
-  
-  destination_db_tpl = copy.deepcopy(config.common_data)
-  destination_db_tpl.update(config.destination_db)
 
-  merger = Merger(config.execution_mode, destination_db_map, source_db_tpl, destination_db_tpl, config, counter, MiniLogger())
-  merger.merge()
-  
+  return Merger(config.execution_mode, destination_db_map, source_db_tpl, destination_db_tpl, config, counter,
+                MiniLogger(), resume)
+
+
+def merge_source(counter, source_db, copy_lock=None):
+  merger = None
+  try:
+    merger = create_merger(counter, source_db)
+    merger.merge(copy_lock)
+
+  except Exception,e:
+    conn = merger._conn if merger else None
+    handle_exception("There was an unexpected error while merging db %s" % source_db['db'], e, conn)
+
+
+def merge_source_in_thread(counter, source_db, copy_lock, slots, failed_dbs):
+  with slots:
+    try:
+      merge_source(counter, source_db, copy_lock)
+    except SystemExit:
+      # handle_exception already reported the error and rolled back
+      failed_dbs.append(source_db['db'])
+
+
+def merge_single_pass():
+  # All the dbs are prepared and committed first, then each table is copied
+  # from all of them with a single statement
+  mergers = []
+  merger = None
+  try:
+    for counter, source_db in enumerate(config.merged_dbs, 1):
+      merger = create_merger(counter, source_db)
+      merger.prepare(True)
+      merger.map_unique_conflicts(True)
+      mergers.append(merger)
+  except Exception,e:
+    conn = merger._conn if merger else None
+    handle_exception("There was an unexpected error while preparing databases", e, conn)
+
+  print "Copying data from all the databases in a single pass"
+  conn = create_connection(destination_db_tpl)
+  try:
+    MultiSourceCopier(mergers, conn, config, MiniLogger()).copy()
+  except Exception,e:
+    handle_exception("There was an unexpected error while copying data", e, conn)
+  conn.close()
+
+  for merger in mergers:
+    try:
+      merger.finish()
+    except Exception,e:
+      handle_exception("There was an unexpected error while finishing the merge", e, merger._conn)
+
+
+print ""
+print "STEP 3. Actually merge all the databases"
+print ""
+if single_pass:
+  merge_single_pass()
+elif config.parallel_sources > 1:
+  # Each source is prepared on its own connection, the unique conflict
+  # step, copying and committing are done by one source at a time
+  copy_lock = threading.Lock()
+  slots = threading.BoundedSemaphore(config.parallel_sources)
+  failed_dbs = []
+  threads = []
+  for counter, source_db in enumerate(config.merged_dbs, 1):
+    thread = threading.Thread(target=merge_source_in_thread,
+                              args=(counter, source_db, copy_lock, slots, failed_dbs))
+    thread.start()
+    threads.append(thread)
+
+  for thread in threads:
+    thread.join()
+
+  if len(failed_dbs):
+    print "Merge failed for databases: %s" % ", ".join(failed_dbs)
+    sys.exit()
+else:
+  for counter, source_db in enumerate(config.merged_dbs, 1):
+    merge_source(counter, source_db)
 
- except Exception,e:
-   conn = merger._conn if globals().has_key('merger') else None
-   handle_exception("There was an unexpected error while merging db %s" % source_db['db'], e, conn)
-   
 print "Merge is finished"
\ No newline at end of file
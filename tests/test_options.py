@@ -0,0 +1,72 @@
+"""
+  Tests of reading config files written for older versions. No database is
+  needed.
+
+  Run from the repository root:
+  python -m unittest discover tests
+"""
+import os
+import sys
+import types
+import unittest
+from enum import Enum
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mysql_merge
+
+# mysql_merge/config.py is written by the user, options are read from it on import
+if not os.path.exists(os.path.join(os.path.dirname(mysql_merge.__file__), 'config.py')):
+    mysql_merge.config = sys.modules['mysql_merge.config'] = types.ModuleType('mysql_merge.config')
+
+from mysql_merge.modes import ExecutionMode, PkShiftMode
+from mysql_merge.options import DEFAULTS, Options
+
+
+def old_config():
+    # The config file of the first version - with its own ExecutionMode
+    class OldExecutionMode(Enum):
+        DEFAULT = 0
+        DRY_RUN = 1
+        IMPORT_FILE = 2
+
+    module = types.ModuleType('config')
+    module.ExecutionMode = OldExecutionMode
+    module.execution_mode = OldExecutionMode.DRY_RUN
+    module.batch_size = 1
+    module.tables_to_ignore = []
+    return module
+
+
+class OptionsTest(unittest.TestCase):
+    def test_missing_options_get_defaults(self):
+        options = Options(old_config())
+        self.assertEqual(1, options.batch_size)
+        self.assertEqual(DEFAULTS['batch_max_bytes'], options.batch_max_bytes)
+        self.assertEqual(None, options.checkpoint_dir)
+        self.assertEqual(PkShiftMode.UPDATE, options.pk_shift_mode)
+
+    def test_modes_of_old_config_are_read_by_name(self):
+        self.assertEqual(ExecutionMode.DRY_RUN, Options(old_config()).execution_mode)
+
+    def test_set_options_are_kept(self):
+        module = old_config()
+        module.execution_mode = ExecutionMode.STREAM
+        module.pk_shift_mode = PkShiftMode.SELECT
+        module.copy_workers = 4
+        options = Options(module)
+        self.assertEqual(ExecutionMode.STREAM, options.execution_mode)
+        self.assertEqual(PkShiftMode.SELECT, options.pk_shift_mode)
+        self.assertEqual(4, options.copy_workers)
+
+    def test_missing_required_option_raises(self):
+        self.assertRaises(AttributeError, lambda: Options(old_config()).merged_dbs)
+
+    def test_mutable_options_are_shared(self):
+        module = old_config()
+        Options(module).tables_to_ignore.append('log')
+        self.assertEqual(['log'], module.tables_to_ignore)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+  Tests of the copy order of tables. No database is needed.
+
+  Run from the repository root:
+  python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mysql_merge.table_order import dependency_order, dependency_waves, merge_fks
+
+
+def db_map(fks, mapped_fks=None):
+    """
+      Builds a map of tables from dicts of table name -> {column: parent table}
+    """
+    result = {}
+    for key, table_fks in (('fk_host', fks), ('fk_create', mapped_fks or {})):
+        for table_name, columns in table_fks.items():
+            table_map = result.setdefault(table_name, {'fk_host': {}, 'fk_create': {}})
+            for column, parent in columns.items():
+                result.setdefault(parent, {'fk_host': {}, 'fk_create': {}})
+                table_map[key][column] = {'parent': parent, 'parent_col': 'id'}
+    return result
+
+
+class DependencyWavesTest(unittest.TestCase):
+    def test_referenced_tables_come_first(self):
+        tables = db_map({'comment': {'post_id': 'post', 'user_id': 'user'}, 'post': {'user_id': 'user'},
+                         'tag': {}})
+        self.assertEqual(([['tag', 'user'], ['post'], ['comment']], set()), dependency_waves(tables))
+
+    def test_mapped_fks_are_followed(self):
+        tables = db_map({}, {'post': {'user_id': 'user'}})
+        self.assertEqual(([['user'], ['post']], set()), dependency_waves(tables))
+
+    def test_self_reference_is_broken_but_keeps_its_wave(self):
+        tables = db_map({'category': {'parent_id': 'category'}, 'product': {'category_id': 'category'}})
+        self.assertEqual(([['category'], ['product']], set(['category'])), dependency_waves(tables))
+
+    def test_cycle_is_broken_at_one_table(self):
+        tables = db_map({'user': {'avatar_id': 'image'}, 'image': {'owner_id': 'user'},
+                         'post': {'user_id': 'user'}})
+        waves, broken = dependency_waves(tables)
+        self.assertEqual(set(['image']), broken)
+        self.assertEqual([['image'], ['user'], ['post']], waves)
+
+    def test_table_referencing_a_cycle_is_not_broken(self):
+        tables = db_map({'a': {'b_id': 'b'}, 'b': {'a_id': 'a'}, 'c': {'a_id': 'a', 'b_id': 'b'}})
+        waves, broken = dependency_waves(tables)
+        self.assertEqual(1, len(broken))
+        self.assertEqual(['c'], waves[-1])
+
+    def test_references_outside_of_tables_are_ignored(self):
+        tables = db_map({'post': {'user_id': 'user'}, 'comment': {'post_id': 'post'}})
+        self.assertEqual(([['post'], ['comment']], set()), dependency_waves(tables, ['post', 'comment']))
+
+    def test_dependency_order_flattens_waves(self):
+        tables = db_map({'post': {'user_id': 'user'}, 'user': {'team_id': 'team'}})
+        self.assertEqual((['team', 'user', 'post'], set()), dependency_order(tables))
+
+
+class MergeFksTest(unittest.TestCase):
+    def test_fks_of_the_destination_db_order_the_copy(self):
+        source = db_map({'post': {}, 'user': {}})
+        destination = db_map({'post': {'user_id': 'user'}})
+        self.assertEqual([['post', 'user']], dependency_waves(source)[0])
+        self.assertEqual(([['user'], ['post']], set()), dependency_waves(merge_fks(source, destination)))
+
+    def test_self_reference_of_the_destination_db_is_broken(self):
+        source = db_map({'category': {}})
+        destination = db_map({'category': {'parent_id': 'category'}})
+        self.assertEqual(set(['category']), dependency_waves(merge_fks(source, destination), ['category'])[1])
+
+    def test_first_map_wins_for_the_same_column(self):
+        merged = merge_fks(db_map({'post': {'user_id': 'user'}}), db_map({'post': {'user_id': 'account'}}))
+        self.assertEqual('user', merged['post']['fk_host']['user_id']['parent'])
+        self.assertEqual(set(['post', 'user', 'account']), set(merged.keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
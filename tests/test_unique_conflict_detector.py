@@ -0,0 +1,140 @@
+"""
+  Tests of UniqueConflictDetector. No database is needed.
+
+  Run from the repository root:
+  python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mysql_merge.unique_conflict_detector import UniqueConflictDetector
+
+
+INDEXES = {'email': ['email'], 'name_parent': ['name', 'parent_id']}
+
+
+def destination_rows(detector, count):
+    rows = []
+    for pk in range(1, count + 1):
+        values = {'email': 'User%d@Example.com' % pk, 'name': u'name %d' % pk, 'parent_id': pk % 3 or None}
+        rows.append(tuple([pk] + [values[column] for column in detector.get_columns()]))
+    return rows
+
+
+class UniqueConflictDetectorTest(unittest.TestCase):
+    def create_detector(self, memory_budget=1048576, normalize=True, count=100):
+        detector = UniqueConflictDetector(INDEXES, memory_budget, normalize)
+        self.addCleanup(detector.close)
+        self.assertEqual(count, detector.load(destination_rows(detector, count)))
+        return detector
+
+    def test_get_columns_lists_each_column_once(self):
+        detector = UniqueConflictDetector({'a': ['x', 'y'], 'b': ['y', 'z']}, 1024)
+        self.assertEqual(['x', 'y', 'z'], sorted(detector.get_columns()))
+
+    def test_finds_conflicting_rows(self):
+        detector = self.create_detector()
+        self.assertFalse(detector.is_spilled())
+        self.assertEqual([(1005, 5)], detector.find('email', [(1005, 'User5@Example.com'), (1006, 'other')]))
+        self.assertEqual([(1007, 7)], detector.find('name_parent', [(1007, u'name 7', 1), (1008, u'name 8', 1)]))
+
+    def test_tuples_of_indexes_are_kept_apart(self):
+        detector = UniqueConflictDetector({'a': ['x'], 'b': ['y']}, 1048576)
+        self.addCleanup(detector.close)
+        detector.load([(1, 'same', 'other')])
+        self.assertEqual([], detector.find('b', [(2, 'same')]))
+        self.assertEqual([(2, 1)], detector.find('a', [(2, 'same')]))
+
+    def test_nulls_never_conflict(self):
+        detector = self.create_detector()
+        # parent_id of row 3 is NULL in the destination db
+        self.assertEqual([], detector.find('name_parent', [(1003, u'name 3', None)]))
+        self.assertEqual([], detector.find('email', [(1001, None)]))
+
+    def test_normalizes_case_and_trailing_spaces(self):
+        detector = self.create_detector()
+        self.assertEqual([(1002, 2)], detector.find('email', [(1002, 'user2@EXAMPLE.COM  ')]))
+        self.assertEqual([], detector.find('email', [(1003, ' user3@example.com')]))
+
+    def test_compares_exact_values_without_normalization(self):
+        detector = self.create_detector(normalize=False)
+        self.assertEqual([], detector.find('email', [(1002, 'user2@example.com')]))
+        self.assertEqual([(1002, 2)], detector.find('email', [(1002, 'User2@Example.com')]))
+
+    def test_utf8_and_unicode_values_are_equal(self):
+        detector = UniqueConflictDetector({'a': ['x']}, 1048576)
+        self.addCleanup(detector.close)
+        detector.load([(1, u'\u017c\xf3\u0142w')])
+        self.assertEqual([(2, 1)], detector.find('a', [(2, u'\u017b\xd3\u0141W'.encode('utf8'))]))
+
+    def test_binary_values_are_compared_as_they_are(self):
+        detector = UniqueConflictDetector({'a': ['x']}, 1048576)
+        self.addCleanup(detector.close)
+        detector.load([(1, '\xff\xfeA')])
+        self.assertEqual([], detector.find('a', [(2, '\xff\xfea')]))
+        self.assertEqual([(3, 1)], detector.find('a', [(3, '\xff\xfeA')]))
+
+    def test_first_destination_row_wins(self):
+        detector = UniqueConflictDetector({'a': ['x']}, 1048576)
+        self.addCleanup(detector.close)
+        detector.load([(1, 'Value'), (2, 'value ')])
+        self.assertEqual([(3, 1)], detector.find('a', [(3, 'VALUE')]))
+
+    def test_spills_to_disk_over_memory_budget(self):
+        detector = self.create_detector(memory_budget=UniqueConflictDetector.ENTRY_SIZE * 10, count=1000)
+        self.assertTrue(detector.is_spilled())
+        self.assertEqual({}, detector._digests)
+        path = detector._db_path
+        self.assertTrue(os.path.exists(path))
+
+        self.assertEqual([(2001, 1), (2999, 999)], detector.find('email', [
+            (2001, 'user1@example.com'), (2002, 'nobody@example.com'), (2999, 'USER999@example.com')]))
+        self.assertEqual([(3010, 10)], detector.find('name_parent', [(3010, u'name 10', 1), (3011, u'name 10', 2)]))
+
+        detector.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_spilled_first_destination_row_wins(self):
+        detector = UniqueConflictDetector({'a': ['x']}, UniqueConflictDetector.ENTRY_SIZE * 2)
+        self.addCleanup(detector.close)
+        detector.load([(1, 'a'), (2, 'b'), (3, 'c'), (4, 'C'), (5, 'd')])
+        self.assertTrue(detector.is_spilled())
+        self.assertEqual([(6, 3)], detector.find('a', [(6, 'c')]))
+
+    def test_bloom_filter_answers_misses_without_disk(self):
+        detector = self.create_detector(memory_budget=UniqueConflictDetector.ENTRY_SIZE * 10, count=1000)
+        self.assertTrue(detector.is_spilled())
+        for pk in range(1, 1001):
+            self.assertTrue(detector._bloom_contains(detector._digest('email', ['user%d@example.com' % pk])))
+
+        misses = [(pk, 'nobody%d@example.com' % pk) for pk in range(1000)]
+        rejected = sum(1 for _, email in misses if not detector._bloom_contains(detector._digest('email', [email])))
+        self.assertTrue(rejected > 900)
+
+        # Lookups of rejected rows never reach sqlite
+        detector._db.close()
+        detector._db = ClosedDb(detector._db_path)
+        self.assertEqual([], detector.find('email', [
+            miss for miss in misses if not detector._bloom_contains(detector._digest('email', [miss[1]]))]))
+
+
+class ClosedDb(object):
+    """
+      Stands in for the spill db of a detector, fails on any query
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def execute(self, *args):
+        raise AssertionError("sqlite queried for a row rejected by the Bloom filter")
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()